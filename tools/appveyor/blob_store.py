@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+import argparse
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+import stat
+import sys
+from typing import Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+logger.setLevel(logging.DEBUG)
+
+# How files are made available from the store.
+LINK_MODES = ['hardlink', 'symlink', 'copy']
+
+# Size of the chunks used to hash files.
+HASH_CHUNK_SIZE = 1 << 20
+
+# Blobs are shared by all their links: they must never be written in place.
+BLOB_MODE = 0o444
+
+
+def file_digest(file_path: pathlib.Path) -> str:
+    digest = hashlib.sha256()
+    with open(str(file_path), 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_path(store_dir: pathlib.Path, digest: str) -> pathlib.Path:
+    # e.g.: <store>/3f/3fa2...; avoids having thousands of files in a dir.
+    return store_dir.joinpath(digest[:2], digest)
+
+
+def remove_file(file_path: pathlib.Path):
+    """Remove a file, even if it's read-only (e.g. a link to a blob; Windows
+    refuses to delete read-only files)."""
+    try:
+        os.remove(str(file_path))
+    except PermissionError:
+        os.chmod(str(file_path), stat.S_IWRITE | stat.S_IREAD)
+        os.remove(str(file_path))
+
+
+def add_file(store_dir: pathlib.Path, file_path: pathlib.Path,
+             digest: Optional[str] = None,
+             move: bool = False) -> pathlib.Path:
+    """Add a file to the store (if not already there) and return its blob
+    path.
+
+    `digest` can be given if the file hash is already known. If `move` is
+    set, the file is moved (not copied) to the store; it must be on the same
+    drive.
+    """
+    blob = blob_path(store_dir, digest or file_digest(file_path))
+    if blob.exists():
+        logger.debug("'{}' already in store as '{}'".format(
+            file_path.name, blob.name))
+        os.chmod(str(blob), BLOB_MODE)
+        return blob
+
+    os.makedirs(str(blob.parent), exist_ok=True)
+    if move:
+        os.replace(str(file_path), str(blob))
+    else:
+        # copy then rename, so an interrupted copy never leaves a bad blob.
+        tmp_blob = blob.with_name(blob.name + ".tmp")
+        shutil.copy2(str(file_path), str(tmp_blob))
+        os.replace(str(tmp_blob), str(blob))
+    os.chmod(str(blob), BLOB_MODE)
+    logger.debug("Added '{}' to store as '{}'".format(file_path.name,
+                                                      blob.name))
+    return blob
+
+
+def link_file(blob: pathlib.Path, dest_path: pathlib.Path,
+              link_mode: str = 'hardlink') -> str:
+    """Make `dest_path` point to a blob.
+
+    Falls back to a copy if the link can't be made (e.g. the store is on
+    another drive or symlinks are not allowed). Returns the mode used.
+    """
+    if dest_path.exists() or dest_path.is_symlink():
+        remove_file(dest_path)
+        # removing a read-only hardlink may have made the blob writable.
+        os.chmod(str(blob), BLOB_MODE)
+
+    try:
+        if link_mode == 'hardlink':
+            os.link(str(blob), str(dest_path))
+            return link_mode
+        if link_mode == 'symlink':
+            os.symlink(str(blob.resolve()), str(dest_path))
+            return link_mode
+    except OSError as err:
+        logger.warning("Couldn't {} '{}' to '{}', copying instead. The error "
+                       "was: {}".format(link_mode, blob, dest_path, err))
+
+    # a copy doesn't share the blob inode, it can stay writable.
+    shutil.copy2(str(blob), str(dest_path))
+    os.chmod(str(dest_path), stat.S_IWRITE | stat.S_IREAD)
+    return 'copy'
+
+
+def install_file(store_dir: pathlib.Path, file_path: pathlib.Path,
+                 dest_path: pathlib.Path, link_mode: str = 'hardlink',
+                 digest: Optional[str] = None, move: bool = False) -> str:
+    """Add a file to the store and link it at `dest_path`."""
+    blob = add_file(store_dir, file_path, digest, move)
+    return link_file(blob, dest_path, link_mode)
+
+
+def contains(store_dir: pathlib.Path, digest: str) -> bool:
+    return blob_path(store_dir, digest).exists()
+
+
+def iter_blobs(store_dir: pathlib.Path) -> Iterable[pathlib.Path]:
+    for blob in store_dir.glob("*/*"):
+        if blob.is_file() and not blob.name.endswith(".tmp"):
+            yield blob
+
+
+def symlinked_blobs(store_dir: pathlib.Path,
+                    roots: Iterable[pathlib.Path]) -> Set[pathlib.Path]:
+    store_dir = store_dir.resolve()
+    referenced = set()
+    for root in roots:
+        for path in root.rglob("*"):
+            if not path.is_symlink():
+                continue
+            target = path.resolve()
+            if store_dir in target.parents:
+                referenced.add(target)
+    return referenced
+
+
+def collect_garbage(store_dir: pathlib.Path, roots: List[pathlib.Path],
+                    dry_run: bool = False) -> Tuple[int, int]:
+    """Remove the blobs that are not referenced anymore.
+
+    A blob is referenced if it has other hardlinks or if a symlink under one
+    of the `roots` directories points to it.
+
+    Returns the number of removed blobs and their total size.
+    """
+    referenced = symlinked_blobs(store_dir, roots)
+    removed = removed_size = 0
+    for blob in iter_blobs(store_dir):
+        stat = blob.stat()
+        if stat.st_nlink > 1 or blob.resolve() in referenced:
+            continue
+
+        logger.info("Removing unreferenced blob: '{}'".format(blob.name))
+        if not dry_run:
+            remove_file(blob)
+        removed += 1
+        removed_size += stat.st_size
+
+    return removed, removed_size
+
+
+def banner_execute() -> pathlib.Path:
+    script_path = pathlib.Path(os.path.realpath(__file__))
+    sep = "-" * 79
+    print("{}\nExecuting: {}\n{}".format(sep, script_path.name, sep))
+    return script_path
+
+
+def main(args):
+    banner_execute()
+
+    if not args.store_dir.exists() or not args.store_dir.is_dir():
+        logger.error("Store: '{}' either doesn't exist or is not a directory."
+                     .format(args.store_dir))
+        return -1
+
+    for root in args.roots:
+        if not root.exists() or not root.is_dir():
+            logger.error("Root: '{}' either doesn't exist or is not a "
+                         "directory.".format(root))
+            return -1
+
+    removed, removed_size = collect_garbage(args.store_dir, args.roots,
+                                            args.dry_run)
+    logger.info("{} blob(s) removed ({} bytes).".format(removed,
+                                                        removed_size))
+    return 0
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Garbage collect the content-addressed DLL store: remove "
+                    "blobs that are not linked from any libs directory.")
+
+    arg_parser.add_argument(
+        'store_dir', action="store", type=pathlib.Path,
+        help="Directory of the blob store.")
+
+    arg_parser.add_argument(
+        '-r', '--root', action='append', dest='roots', default=[],
+        type=pathlib.Path,
+        help="Directory that may contain symlinks to the store (e.g. the "
+             "'libs' directory). [Note: hardlinked blobs are always kept].")
+
+    arg_parser.add_argument(
+        '-n', '--dry_run', action="store_true", default=False,
+        help="Only list the blobs that would be removed. [default: False]")
+
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
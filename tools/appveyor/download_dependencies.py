@@ -4,6 +4,7 @@ from typing import Optional
 import argparse
 import sys
 import requests
+import urllib3
 import urllib.parse
 import os
 import json
@@ -11,6 +12,13 @@ import pathlib
 import zipfile
 import shutil
 import logging
+import time
+
+import blob_store
+
+# shared tools modules (in the parent directory)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import stage_timings  # noqa: E402
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -22,6 +30,20 @@ HTTP_HEADERS = {
     'User-Agent': 'neitsa',
 }
 
+# Size of the blocks read from the network and written to the file.
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+# Written blocks are a multiple of this size (usual file system block size).
+WRITE_ALIGNMENT = 4096
+
+# Chunk size of the legacy write path (iter_content).
+LEGACY_CHUNK_SIZE = 2048
+
+
+class IncompleteDownloadError(IOError):
+    """The server sent less (or more) data than announced."""
+    pass
+
 
 class UrlDescriptor(object):
     GITHUB_LATEST_TEMPLATE = "https://api.github.com/repos/{}/releases/latest"
@@ -144,9 +166,13 @@ class UrlDescriptor(object):
 
 class UrlDownloader(object):
 
-    def __init__(self, url_descriptor: Optional[UrlDescriptor] = None):
+    def __init__(self, url_descriptor: Optional[UrlDescriptor] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 legacy_write: bool = False):
         self._current_url_desc = url_descriptor
         self._download_path = None
+        self._chunk_size = chunk_size
+        self._legacy_write = legacy_write
 
     @property
     def current_url_descriptor(self):
@@ -186,7 +212,8 @@ class UrlDownloader(object):
                 latest_release_url, download_path)
             return download_path is not None
         else:
-            return self.download_file(url_descriptor.url, download_path)
+            return self.download_file(url_descriptor.url, download_path,
+                                      self._chunk_size, self._legacy_write)
 
     def download_latest_github_release(
             self, url: Optional[str] = None,
@@ -201,14 +228,84 @@ class UrlDownloader(object):
             else:
                 raise ValueError("No URL descriptor.")
 
-        if not self.download_file(url, download_path):
+        if not self.download_file(url, download_path, self._chunk_size,
+                                  self._legacy_write):
             return None
 
         self._download_path = download_path
         return self._download_path
 
     @staticmethod
-    def download_file(url: str, download_path: pathlib.Path) -> bool:
+    def _write_iter_content(response: requests.Response,
+                            download_path: pathlib.Path) -> int:
+        """Legacy write path: small chunks through a buffered file."""
+        written = 0
+        with open(str(download_path), 'wb') as f:
+            for chunk in response.iter_content(chunk_size=LEGACY_CHUNK_SIZE):
+                if chunk:  # filter out keep-alive new chunks
+                    f.write(chunk)
+                    written += len(chunk)
+        return written
+
+    @staticmethod
+    def _write_raw_stream(response: requests.Response,
+                          download_path: pathlib.Path,
+                          chunk_size: int) -> int:
+        """Read the raw stream into a single reusable buffer and write it to
+        the file in large aligned blocks.
+
+        Note: urllib3 still reads in its own bytes objects and copies them in
+        the buffer; what's saved is the many small buffered writes.
+        """
+        chunk_size = max(WRITE_ALIGNMENT,
+                         chunk_size // WRITE_ALIGNMENT * WRITE_ALIGNMENT)
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        raw = response.raw
+        raw.decode_content = True
+        content_length = int(response.headers.get('Content-Length', 0))
+
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | \
+            getattr(os, 'O_BINARY', 0)
+        fd = os.open(str(download_path), flags, 0o644)
+        try:
+            # reserve the whole file up front (less fragmentation, and fail
+            # early if the disk is full).
+            if content_length:
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, 0, content_length)
+                else:
+                    os.ftruncate(fd, content_length)
+            written = 0
+            eof = False
+            while not eof:
+                # fill the whole buffer before writing it.
+                filled = 0
+                while filled < chunk_size:
+                    read = raw.readinto(view[filled:])
+                    if not read:
+                        eof = True
+                        break
+                    filled += read
+
+                offset = 0
+                while offset < filled:
+                    offset += os.write(fd, view[offset:filled])
+                # the downloaded file isn't read back: start writing the
+                #  block out and don't keep it in the page cache.
+                if filled and hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(fd, written, filled,
+                                     os.POSIX_FADV_DONTNEED)
+                written += filled
+        finally:
+            os.close(fd)
+
+        return written
+
+    @staticmethod
+    def download_file(url: str, download_path: pathlib.Path,
+                      chunk_size: int = DEFAULT_CHUNK_SIZE,
+                      legacy_write: bool = False) -> bool:
         logger.info("Downloading:\n\tURL: {}\n\tDestination path: {}"
                     .format(url, download_path))
 
@@ -248,12 +345,52 @@ class UrlDownloader(object):
                     "{}\n\tThe error was: {}".format(download_path, err))
                 return False
 
-        with open(download_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=2048):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
+        # the raw stream can only be read as is for non encoded content;
+        # otherwise let requests decode it.
+        encoding = response.headers.get('Content-Encoding', 'identity')
+        if encoding.lower() != 'identity':
+            legacy_write = True
+
+        # the announced length is the encoded one: only check it as is for non
+        # encoded content.
+        content_length = None
+        if encoding.lower() == 'identity' and \
+                'Content-Length' in response.headers:
+            content_length = int(response.headers['Content-Length'])
+
+        start = time.perf_counter()
+        try:
+            with stage_timings.stage("download") as stage:
+                if legacy_write:
+                    written = UrlDownloader._write_iter_content(
+                        response, download_path)
+                else:
+                    written = UrlDownloader._write_raw_stream(
+                        response, download_path, chunk_size)
+                stage.bytes = written
+                if content_length is not None and written != content_length:
+                    raise IncompleteDownloadError(
+                        "got {} bytes, expected {} bytes".format(
+                            written, content_length))
+        except (OSError, requests.RequestException,
+                urllib3.exceptions.HTTPError) as err:
+            logger.error("Couldn't write downloaded file: {}\n\tThe error "
+                         "was: {}".format(download_path, err))
+            # never leave a partial (or preallocated) file behind.
+            try:
+                if download_path.exists():
+                    os.remove(str(download_path))
+            except OSError as remove_err:
+                logger.error("Couldn't remove the partial download: {}\n\t"
+                             "The error was: {}".format(download_path,
+                                                        remove_err))
+            return False
+        elapsed = time.perf_counter() - start
 
         logger.info("Successfully downloaded file!")
+        logger.info("{} bytes in {:.3f}s ({:.2f} MB/s, {} write path)".format(
+            written, elapsed, written / elapsed / (1 << 20) if elapsed else 0,
+            "legacy" if legacy_write else "raw stream"))
 
         return True
 
@@ -319,16 +456,40 @@ class UrlDownloader(object):
             return archive.infolist()[0].filename
 
 
-def copy_to_dir(source_dir: pathlib.Path, dest_dir: pathlib.Path) -> bool:
+def copy_to_dir(source_dir: pathlib.Path, dest_dir: pathlib.Path,
+                store_dir: Optional[pathlib.Path] = None,
+                link_mode: str = 'hardlink') -> bool:
     if not source_dir.exists() or not source_dir.is_dir():
         return False
 
     if not dest_dir.exists() or not dest_dir.is_dir():
         return False
 
-    for dll_file in source_dir.glob("**/*.dll"):
-        logger.info("Copying '{}' to '{}'".format(dll_file, dest_dir))
-        shutil.copy2(str(dll_file), str(dest_dir))
+    with stage_timings.stage("copy") as stage:
+        for dll_file in source_dir.glob("**/*.dll"):
+            if store_dir:
+                # put the DLL in the store and link it from the destination
+                logger.info("Storing '{}' and linking it in '{}'".format(
+                    dll_file, dest_dir))
+                digest = blob_store.file_digest(dll_file)
+                if blob_store.contains(store_dir, digest):
+                    stage.cache_hits += 1
+                else:
+                    stage.cache_misses += 1
+                    stage.bytes += dll_file.stat().st_size
+                blob_store.install_file(store_dir, dll_file,
+                                        dest_dir.joinpath(dll_file.name),
+                                        link_mode, digest)
+            else:
+                logger.info("Copying '{}' to '{}'".format(dll_file, dest_dir))
+                # unlink first: the destination might be a link to a blob.
+                dest_path = dest_dir.joinpath(dll_file.name)
+                if dest_path.exists() or dest_path.is_symlink():
+                    blob_store.remove_file(dest_path)
+                shutil.copy2(str(dll_file), str(dest_path))
+                stage.bytes += dll_file.stat().st_size
+
+    return True
 
 
 def banner_execute() -> pathlib.Path:
@@ -338,6 +499,7 @@ def banner_execute() -> pathlib.Path:
     return script_path
 
 
+@stage_timings.record("download_dependencies")
 def main(args):
     banner_execute()
 
@@ -345,7 +507,8 @@ def main(args):
     for url in args.url_list:
         urls.append(UrlDescriptor(url))
 
-    downloader = UrlDownloader()
+    downloader = UrlDownloader(chunk_size=args.chunk_size,
+                               legacy_write=args.legacy_write)
 
     for url_descriptor in urls:
         downloader.current_url_descriptor = url_descriptor
@@ -358,9 +521,10 @@ def main(args):
             continue
 
         # extract package
-        if not downloader.extract(
-                extract_path=args.extract_path, password=args.zip_password):
-            return -1
+        with stage_timings.stage("extract"):
+            if not downloader.extract(extract_path=args.extract_path,
+                                      password=args.zip_password):
+                return -1
 
         # copy extracted files to destination
         if args.copy_destination and downloader.download_path:
@@ -373,7 +537,9 @@ def main(args):
                 # append the directory at the 'top' of the zip
                 copy_source = args.extract_path.joinpath(dir_name)
             # copy
-            copy_to_dir(copy_source, args.copy_destination)
+            if not copy_to_dir(copy_source, args.copy_destination,
+                               args.store_dir, args.link_mode):
+                return -1
 
     return 0
 
@@ -396,6 +562,27 @@ if __name__ == "__main__":
         '-c', '--copy_destination', action="store", type=pathlib.Path,
         help="Directory where to copy all DLLs from downloaded package.")
 
+    arg_parser.add_argument(
+        '-s', '--store_dir', action="store", type=pathlib.Path,
+        help="Content-addressed store directory. If given, copied DLLs are "
+             "put in the store and linked from the copy destination. "
+             "[default: plain copy]")
+
+    arg_parser.add_argument(
+        '-l', '--link_mode', action="store", default='hardlink',
+        choices=blob_store.LINK_MODES,
+        help="How DLLs are linked from the store. [default: hardlink]")
+
+    arg_parser.add_argument(
+        '--chunk_size', action="store", type=int, default=DEFAULT_CHUNK_SIZE,
+        help="Size (in bytes) of the blocks read and written while "
+             "downloading. [default: {}]".format(DEFAULT_CHUNK_SIZE))
+
+    arg_parser.add_argument(
+        '--legacy_write', action="store_true", default=False,
+        help="Use the old write path (small iter_content chunks), e.g. to "
+             "compare throughput. [default: False]")
+
     arg_parser.add_argument(
         '-x', '--extract', action="store_true", default=False,
         help="Extract zip files [default: False]")
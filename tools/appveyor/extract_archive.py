@@ -4,10 +4,17 @@ import sys
 import logging
 import os.path
 import argparse
-import subprocess
+import tempfile
 from typing import Optional
 from pathlib import Path
 
+import blob_store
+
+# shared tools modules (in the parent directory)
+sys.path.append(str(Path(os.path.realpath(__file__)).parent.parent))
+import stage_timings  # noqa: E402
+import tool_runner  # noqa: E402
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 logger.setLevel(logging.DEBUG)
@@ -30,6 +37,46 @@ def get_latest_file_in_dir(dir_path: Path) -> Optional[Path]:
     return latest_file
 
 
+def store_extracted_files(extract_dir: Path, output_path: Path,
+                          store_dir: Path, link_mode: str,
+                          stage: stage_timings.Stage):
+    """Move extracted files to the store and link them in the output path
+    (keeping the extracted directory structure)."""
+    for file in sorted(extract_dir.rglob("*")):
+        if file.is_dir():
+            continue
+
+        dest_path = output_path.joinpath(file.relative_to(extract_dir))
+        os.makedirs(str(dest_path.parent), exist_ok=True)
+        digest = blob_store.file_digest(file)
+        if blob_store.contains(store_dir, digest):
+            stage.cache_hits += 1
+        else:
+            stage.cache_misses += 1
+            stage.bytes += file.stat().st_size
+        mode = blob_store.install_file(store_dir, file, dest_path, link_mode,
+                                       digest, move=True)
+        logger.info("{}: '{}'".format(mode, dest_path))
+
+
+def move_extracted_files(extract_dir: Path, output_path: Path):
+    """Move extracted files to the output path (keeping the extracted
+    directory structure).
+
+    Existing files are unlinked first, never overwritten in place: they
+    might be links to blobs of the store.
+    """
+    for file in sorted(extract_dir.rglob("*")):
+        if file.is_dir():
+            continue
+
+        dest_path = output_path.joinpath(file.relative_to(extract_dir))
+        os.makedirs(str(dest_path.parent), exist_ok=True)
+        if dest_path.exists() or dest_path.is_symlink():
+            blob_store.remove_file(dest_path)
+        os.replace(str(file), str(dest_path))
+
+
 def banner_execute() -> Path:
     script_path = Path(os.path.realpath(__file__))
     sep = "-" * 79
@@ -37,51 +84,72 @@ def banner_execute() -> Path:
     return script_path
 
 
+def build_command(input_file: Path, output_path: Path, program_path: str,
+                  extract_method: str, args) -> tool_runner.ToolCommand:
+    # -o option must be attached to the directory, otherwise it doesn't work...
+    o_switch = "-o{}".format(str(output_path))
+
+    # -bsp1: progress to stdout; -y: don't ask anything (no console input)
+    subprocess_args = [str(program_path), extract_method, str(input_file),
+                       o_switch, "-bsp1", "-y"]
+
+    # check for password, if any
+    if args.password:
+        subprocess_args.append("-p{}".format(args.password))
+
+    # check for extensions
+    if args.extension_list:
+        for extension in args.extension_list:
+            subprocess_args.append(extension)
+        subprocess_args.append("-r")
+
+    if args.timeout:
+        timeout = args.timeout
+    else:
+        timeout = tool_runner.adaptive_timeout(input_file.stat().st_size)
+
+    return tool_runner.ToolCommand(subprocess_args, input_file.name, timeout)
+
+
+@stage_timings.record("extract_archive")
 def main(args):
     banner_execute()
 
-    # check if input path exists
-    if not args.input_file.exists():
-        logger.error("Input file: '{}' doesn't exist.".format(args.input_file))
-        return -1
+    input_files = list()
+    for input_path in args.input_files:
+        # check if input path exists
+        if not input_path.exists():
+            logger.error("Input file: '{}' doesn't exist.".format(input_path))
+            return -1
 
-    # check input path type (either dir or file)
-    if not args.input_file.is_dir():
-        input_file = args.input_file
-    else:
-        # it's a directory
-        # default to the latest (by creation time) file in the directory
-        input_file = get_latest_file_in_dir(args.input_file)
+        # check input path type (either dir or file)
+        if not input_path.is_dir():
+            input_files.append(input_path)
+        else:
+            # it's a directory
+            # default to the latest (by creation time) file in the directory
+            input_files.append(get_latest_file_in_dir(input_path))
 
     # check output path
-    if not args.output_path:
-        # no output path given:
-        # if input path is a dir, take it. If it's a file, take its directory
-        output_path = input_file if input_file.is_dir() else input_file.parent
-    else:
+    if args.output_path:
         # check if output path exists and it's a directory
         if not args.output_path.exists() or not args.output_path.is_dir():
             logger.error(
                 "Output Path: '{}' either doesn't exist or is not a directory."
                 .format(args.output_path))
             return - 1
-        else:
-            output_path = args.output_path
 
     if args.program_path:
         if not args.program_path.exists() or not args.program_path.is_file():
             logger.error(
                 "Program Path: '{}' either doesn't exist or is not a file."
-                .format(args.input_file))
+                .format(args.program_path))
             return -1
         program_path = args.program_path
     else:
         # it's in the path
         program_path = "7z"
 
-    # -o option must be attached to the directory, otherwise it doesn't work...
-    o_switch = "-o{}".format(str(output_path))
-
     # extraction method
     if args.extract_method:
         if args.extract_method not in EXTRACT_METHODS:
@@ -93,47 +161,72 @@ def main(args):
     else:
         extract_method = "x"
 
-    subprocess_args = [str(program_path), extract_method, str(input_file),
-                       o_switch]
-
-    # check for password, if any
-    if args.password:
-        subprocess_args.append("-p{}".format(args.password))
-
-    # check for extensions
-    if args.extension_list:
-        for extension in args.extension_list:
-            subprocess_args.append(extension)
-        subprocess_args.append("-r")
-
-    try:
-        # extract using 7zip (must be in PATH env. variable)
-        process = subprocess.run(subprocess_args, stdout=subprocess.PIPE,
-                                 timeout=10)
-    except Exception as err:
-        logger.error("An error occured while trying to run the program."
-                     "\n\tThe error was: {}".format(err))
-        return -1
-
-    if process.stdout != b'':
-        print(process.stdout.decode("utf-8"))
-
-    if process.returncode != 0:
-        logging.error("An error occured from 7z. Return code: {}".format(
-            process.returncode))
-    else:
-        print("7z success. Return code: {}".format(process.returncode))
-
-    return process.returncode
+    # extract in a temporary directory, then move the files to the output
+    # path. With a store, the temporary directory is next to the store (same
+    # drive, so files can be moved in it and hardlinked afterward).
+    if args.store_dir:
+        os.makedirs(str(args.store_dir), exist_ok=True)
+
+    commands = list()
+    # (output path, temporary extract directory) for each input file
+    destinations = list()
+    for input_file in input_files:
+        # no output path given: take the input file directory
+        output_path = args.output_path or input_file.parent
+        extract_dir = tempfile.TemporaryDirectory(
+            dir=str(args.store_dir or output_path))
+        destinations.append((output_path, extract_dir))
+        commands.append(build_command(
+            input_file, Path(extract_dir.name), program_path, extract_method,
+            args))
+
+    # extract using 7zip (must be in PATH env. variable)
+    with stage_timings.stage("extract") as stage:
+        stage.bytes = sum(f.stat().st_size for f in input_files)
+        results = tool_runner.run(tool_runner.run_tools(
+            commands, args.jobs, on_progress=tool_runner.print_progress))
+
+    return_code = 0
+    for result, (output_path, extract_dir) in zip(results, destinations):
+        name = result.command.name
+        if result.error:
+            logger.error("An error occured while trying to run the program."
+                         "\n\tThe error was: {}".format(result.error))
+            return_code = return_code or -1
+        elif result.timed_out:
+            logger.error("7z timed out after {:.0f}s on '{}'.".format(
+                result.command.timeout, name))
+            return_code = return_code or -1
+        elif result.return_code != 0:
+            logging.error("An error occured from 7z on '{}'. Return code: {}"
+                          .format(name, result.return_code))
+            return_code = return_code or result.return_code
+        else:
+            print("7z success on '{}' ({:.2f}s). Return code: {}".format(
+                name, result.duration, result.return_code))
+
+        with extract_dir:
+            if result.return_code != 0 or result.timed_out:
+                continue
+            if args.store_dir:
+                with stage_timings.stage("store") as stage:
+                    store_extracted_files(
+                        Path(extract_dir.name), output_path,
+                        args.store_dir, args.link_mode, stage)
+            else:
+                move_extracted_files(Path(extract_dir.name), output_path)
+
+    return return_code
 
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser(
         description="Extract archive using 7zip.")
 
     arg_parser.add_argument(
-        'input_file', action="store", type=Path,
-        help="The archive file to extract. [Note: if this argument defines "
-             "a directory, the latest file (by creation time) in this "
+        'input_files', action="store", type=Path, nargs='+',
+        metavar='input_file',
+        help="One or more archive files to extract. [Note: if this argument "
+             "defines a directory, the latest file (by creation time) in this "
              "directory is used instead].")
 
     arg_parser.add_argument(
@@ -155,6 +248,27 @@ if __name__ == "__main__":
         help="Full path to 7Zip program if needed. [default: use the PATH env. "
              "var.]")
 
+    arg_parser.add_argument(
+        '-s', '--store_dir', action="store", type=Path,
+        help="Content-addressed store directory. If given, extracted files "
+             "are put in the store and linked from the output path. "
+             "[default: extract directly to the output path]")
+
+    arg_parser.add_argument(
+        '-l', '--link_mode', action="store", default='hardlink',
+        choices=blob_store.LINK_MODES,
+        help="How files are linked from the store. [default: hardlink]")
+
+    arg_parser.add_argument(
+        '-t', '--timeout', action="store", type=float,
+        help="Timeout (in seconds) for each archive. [default: scaled from "
+             "the archive size]")
+
+    arg_parser.add_argument(
+        '-j', '--jobs', action="store", type=int, default=os.cpu_count() or 1,
+        help="Number of archives extracted concurrently. "
+             "[default: CPU count]")
+
     arg_parser.add_argument(
         '-x', '--extract_method', action="store",
         help="7Zip extraction method, must be 'e' or 'x' [default: x]")
@@ -0,0 +1,283 @@
+#!/usr/bin/python3.6
+# -*- coding: UTF-8 -*-
+import argparse
+import hashlib
+import os
+import pathlib
+import sys
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import json_cache
+
+# Location of the languages in a mod folder.
+MOD_LANGUAGES = "Languages"
+
+# Location of the keyed translations in a language folder.
+LANGUAGE_KEYED = "Keyed"
+
+# Root tag of a RimWorld translation file.
+LANGUAGE_DATA_TAG = "LanguageData"
+
+# Name of the bundled file (one per language).
+BUNDLE_NAME = "PrepareLanding.xml"
+
+# Default location of the cache file.
+DEFAULT_CACHE_FILE = json_cache.CACHE_DIR.joinpath("bundle_languages.json")
+
+
+class BundleError(Exception):
+    pass
+
+
+def banner_execute() -> pathlib.Path:
+    script_path = pathlib.Path(os.path.realpath(__file__))
+    sep = "-" * 79
+    print("{}\nExecuting: {}\n{}".format(sep, script_path.name, sep))
+    return script_path
+
+
+def dir_exists(path_str: pathlib, check_absolute: bool = False) -> bool:
+    path = pathlib.Path(path_str)
+    if not path.exists() or not path.is_dir():
+        print("Provided path '{}' doesn't exists or is not a directory."
+              .format(path_str), file=sys.stderr)
+        return False
+
+    if check_absolute:
+        if not path.is_absolute():
+            print("Provided path '{}' is not an absolute path."
+                  .format(path_str), file=sys.stderr)
+            return False
+
+    return True
+
+
+def keyed_files(keyed_dir: pathlib.Path) -> List[pathlib.Path]:
+    return sorted(path for path in keyed_dir.iterdir()
+                  if path.is_file() and path.suffix.lower() == ".xml")
+
+
+def hash_files(files: List[pathlib.Path]) -> str:
+    digest = hashlib.sha256()
+    for path in files:
+        digest.update(path.name.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(path.read_bytes())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def bundle_language(keyed_dir: pathlib.Path) -> Tuple[List[str], bytes]:
+    """Merge the keyed files of a language; returns its keys and the
+    minified bundle."""
+    bundle = ElementTree.Element(LANGUAGE_DATA_TAG)
+    # key -> file where the key was first seen.
+    keys = dict()
+    for path in keyed_files(keyed_dir):
+        try:
+            root = ElementTree.parse(str(path)).getroot()
+        except ElementTree.ParseError as err:
+            raise BundleError("Couldn't parse '{}': {}".format(path, err))
+
+        if root.tag != LANGUAGE_DATA_TAG:
+            raise BundleError("Unexpected root tag '{}' in '{}'."
+                              .format(root.tag, path))
+
+        for element in root:
+            if element.tag in keys:
+                raise BundleError(
+                    "Duplicated key '{}' in '{}' (already defined in '{}')."
+                    .format(element.tag, path.name, keys[element.tag]))
+            keys[element.tag] = path.name
+            element.tail = None
+            bundle.append(element)
+
+    # no indentation: the only whitespace left is the one in the values.
+    bundle.text = None
+    content = '<?xml version="1.0" encoding="utf-8"?>{}'.format(
+        ElementTree.tostring(bundle, encoding="unicode")).encode("utf-8")
+    return list(keys), content
+
+
+def bundle_language_worker(keyed_dir: str) -> Tuple[List[str], bytes]:
+    return bundle_language(pathlib.Path(keyed_dir))
+
+
+def check_coverage(language_keys: Dict[str, List[str]],
+                   reference: Optional[str]) -> int:
+    """Returns the number of languages with missing or unknown keys."""
+    if reference not in language_keys:
+        print("Reference language '{}' not found, skipping coverage check."
+              .format(reference), file=sys.stderr)
+        return 0
+
+    reference_keys = set(language_keys[reference])
+    problems = 0
+    for language, keys in sorted(language_keys.items()):
+        if language == reference:
+            continue
+        missing = sorted(reference_keys - set(keys))
+        extra = sorted(set(keys) - reference_keys)
+        print("{}: {}/{} keys translated.".format(
+            language, len(reference_keys) - len(missing),
+            len(reference_keys)))
+        if missing:
+            print("\t- missing: {}".format(", ".join(missing)),
+                  file=sys.stderr)
+        if extra:
+            print("\t- not in {}: {}".format(reference, ", ".join(extra)),
+                  file=sys.stderr)
+        if missing or extra:
+            problems += 1
+
+    return problems
+
+
+def write_bundle(output_keyed_dir: pathlib.Path, content: bytes):
+    os.makedirs(str(output_keyed_dir), exist_ok=True)
+    for path in keyed_files(output_keyed_dir):
+        if path.name != BUNDLE_NAME:
+            os.remove(str(path))
+    output_keyed_dir.joinpath(BUNDLE_NAME).write_bytes(content)
+
+
+def main(args):
+    banner_execute()
+
+    # for ex.: <my_repo>\output\PrepareLanding
+    if not dir_exists(args.mod_dir):
+        return -1
+
+    mod_dir = pathlib.Path(args.mod_dir)
+    output_dir = pathlib.Path(args.output_dir)
+    # the keyed files in the output dir are replaced by the bundle: never
+    # do that on the translation sources.
+    if output_dir.resolve() == mod_dir.resolve():
+        print("Output directory '{}' must not be the mod directory (its keyed "
+              "files would be deleted).".format(output_dir), file=sys.stderr)
+        return -1
+
+    languages_dir = mod_dir.joinpath(MOD_LANGUAGES)
+    if not dir_exists(languages_dir):
+        return -1
+
+    cache_file = pathlib.Path(args.cache_file)
+    cache = dict() if args.no_cache else json_cache.load(cache_file)
+
+    # language name -> keyed dir
+    languages = dict()
+    for language_dir in sorted(languages_dir.iterdir()):
+        keyed_dir = language_dir.joinpath(LANGUAGE_KEYED)
+        if keyed_dir.is_dir() and keyed_files(keyed_dir):
+            languages[language_dir.name] = keyed_dir
+
+    language_keys = dict()
+    # language name -> (input file count, input hash, pending future)
+    pending = dict()
+    input_files = output_files = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for language, keyed_dir in languages.items():
+            files = keyed_files(keyed_dir)
+            input_files += len(files)
+            input_hash = hash_files(files)
+            output_keyed_dir = output_dir.joinpath(
+                MOD_LANGUAGES, language, LANGUAGE_KEYED)
+            bundle_path = output_keyed_dir.joinpath(BUNDLE_NAME)
+
+            entry = cache.get(language)
+            if entry and entry["input_hash"] == input_hash and \
+                    bundle_path.exists() and \
+                    keyed_files(output_keyed_dir) == [bundle_path] and \
+                    hash_files([bundle_path]) == entry["output_hash"]:
+                print("{}: up to date (cached).".format(language))
+                language_keys[language] = entry["keys"]
+                output_files += 1
+                continue
+
+            pending[language] = (len(files), input_hash, executor.submit(
+                bundle_language_worker, str(keyed_dir)))
+
+        for language, (file_count, input_hash, future) in pending.items():
+            try:
+                keys, content = future.result()
+            except BundleError as err:
+                print("{}: {}".format(language, err), file=sys.stderr)
+                return -1
+
+            output_keyed_dir = output_dir.joinpath(
+                MOD_LANGUAGES, language, LANGUAGE_KEYED)
+            try:
+                write_bundle(output_keyed_dir, content)
+            except OSError as err:
+                print("Couldn't write bundle in '{}'. The error was: {}"
+                      .format(output_keyed_dir, err), file=sys.stderr)
+                return -1
+
+            print("{}: {} files bundled ({} keys, {} bytes).".format(
+                language, file_count, len(keys), len(content)))
+            language_keys[language] = keys
+            output_files += 1
+            cache[language] = {
+                "input_hash": input_hash,
+                "output_hash": hash_files(
+                    [output_keyed_dir.joinpath(BUNDLE_NAME)]),
+                "keys": keys,
+            }
+
+    if not args.no_cache:
+        json_cache.save(cache_file, cache)
+
+    print("Keyed files: {} -> {}.".format(input_files, output_files))
+
+    problems = check_coverage(language_keys, args.reference)
+    if problems and args.strict:
+        print("{} language(s) with incomplete key coverage.".format(problems),
+              file=sys.stderr)
+        return -1
+
+    return 0
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Bundle the keyed translation files of each language into "
+                    "a single minified file.")
+
+    arg_parser.add_argument(
+        'mod_dir', action="store",
+        help="Full path to the mod directory (e.g. output/PrepareLanding).")
+
+    arg_parser.add_argument(
+        '-o', '--output_dir', action="store", dest="output_dir",
+        required=True,
+        help="Full path to the staging mod directory where the bundles are "
+             "written (e.g. a copy of the mod). The keyed files in this "
+             "directory are replaced by the bundle. [Note: can't be mod_dir]")
+
+    arg_parser.add_argument(
+        '-r', '--reference', action="store", default="English",
+        help="Reference language for the key coverage check. "
+             "[default: English]")
+
+    arg_parser.add_argument(
+        '-s', '--strict', action="store_true", default=False,
+        help="Fail if a language doesn't have the same keys as the reference "
+             "language. [default: False]")
+
+    arg_parser.add_argument(
+        '-c', '--cache_file', action="store", default=str(DEFAULT_CACHE_FILE),
+        help="Cache file path. [default: tools/.cache/bundle_languages.json]")
+
+    arg_parser.add_argument(
+        '--no_cache', action="store_true", default=False,
+        help="Don't read or write the cache. [default: False]")
+
+    arg_parser.add_argument(
+        '-j', '--jobs', action="store", type=int, dest="jobs",
+        default=os.cpu_count() or 1,
+        help="Number of languages processed concurrently. "
+             "[default: CPU count]")
+
+    parsed_args = arg_parser.parse_args()
+    sys.exit(main(parsed_args))
@@ -1,10 +1,16 @@
 #!/usr/bin/python3.6
 # -*- coding: UTF-8 -*-
 import argparse
+import errno
 import sys
 import os
 import pathlib
 import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import stage_timings
 
 # Location of mods in RimWorld game directory.
 RIMWORLD_MOD_DIR = "Mods"
@@ -39,6 +45,124 @@ def dir_exists(path_str: pathlib, check_absolute: bool = False) -> bool:
     return True
 
 
+def plan_binaries(target_dir: pathlib.Path, assemblies_dir: pathlib.Path,
+                  file_types: Iterable[str]) -> Dict[pathlib.Path,
+                                                     List[pathlib.Path]]:
+    """Plan the copy of the built binaries to the 'Assemblies' directory of
+    the version they were built for."""
+    plan = OrderedDict()
+    for file_type in file_types:
+        for file_name in sorted(target_dir.glob(file_type)):
+            plan[file_name] = [assemblies_dir.joinpath(file_name.name)]
+
+    return plan
+
+
+def plan_deploy(src_dir: pathlib.Path, mod_dirs: Iterable[pathlib.Path]) \
+        -> Dict[pathlib.Path, List[pathlib.Path]]:
+    """Plan the copy of the whole mod content to each RimWorld install.
+
+    Source files that are already hardlinked together (e.g. the same DLL in
+    several versioned 'Assemblies' directories) are planned only once.
+
+    Returns a mapping from a source file to all its destinations.
+    """
+    plan = OrderedDict()
+    # (device, inode) -> first source file seen with this identity.
+    seen = dict()
+    for file_name in sorted(src_dir.rglob("*")):
+        if file_name.is_dir():
+            continue
+        relative_path = file_name.relative_to(src_dir)
+        destinations = [mod_dir.joinpath(relative_path)
+                        for mod_dir in mod_dirs]
+        stat = file_name.stat()
+        identity = (stat.st_dev, stat.st_ino)
+        if identity in seen:
+            plan[seen[identity]].extend(destinations)
+        else:
+            seen[identity] = file_name
+            plan[file_name] = destinations
+
+    return plan
+
+
+def copy_or_link(src: pathlib.Path, destinations: List[pathlib.Path],
+                 verbose: bool = False) -> List[Tuple[pathlib.Path, str]]:
+    """Copy `src` once to the first destination, then hardlink all the other
+    destinations to this first copy.
+
+    If a hardlink can't be made (e.g. destinations on different drives) the
+    file is copied instead.
+
+    Returns the list of (destination, action) that were done.
+    """
+    done = list()
+    first = None
+    for dst in destinations:
+        os.makedirs(str(dst.parent), exist_ok=True)
+        # os.link() fails if the destination already exists.
+        if dst.exists() or dst.is_symlink():
+            os.remove(str(dst))
+
+        action = "copied"
+        if first is not None:
+            try:
+                os.link(str(first), str(dst))
+                action = "linked"
+            except OSError:
+                shutil.copy2(str(src), str(dst))
+        else:
+            shutil.copy2(str(src), str(dst))
+            first = dst
+
+        if verbose:
+            print("{}:\n\t- from: '{}'\n\t- to '{}'"
+                  .format(action.capitalize(), src, dst))
+        done.append((dst, action))
+
+    return done
+
+
+def execute_plan(plan: Dict[pathlib.Path, List[pathlib.Path]],
+                 jobs: int, verbose: bool = False,
+                 stage: Optional[stage_timings.Stage] = None) -> bool:
+    """Execute a copy plan (see `plan_binaries` and `plan_deploy`).
+
+    Each source file is handled by its own task so the whole plan is
+    processed concurrently. If a `stage` is given, the copied bytes are
+    counted in it (hardlinks count as cache hits, copies as misses).
+    """
+    copied = linked = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = OrderedDict(
+            (executor.submit(copy_or_link, src, destinations, verbose), src)
+            for src, destinations in plan.items())
+        for future, src in futures.items():
+            try:
+                done = future.result()
+            except Exception as err:
+                print("An error occurred while trying to copy a file.\n"
+                      "src: {}\ndst: {}\nThe error was: {}"
+                      .format(src, plan[src], err), file=sys.stderr)
+                return False
+            for _, action in done:
+                if action == "linked":
+                    linked += 1
+                else:
+                    copied += 1
+                    if stage:
+                        stage.bytes += src.stat().st_size
+
+    if stage:
+        stage.cache_hits += linked
+        stage.cache_misses += copied
+
+    print("{} file(s) copied, {} file(s) hardlinked.".format(copied, linked))
+    return True
+
+
+@stage_timings.record("copy_to_rimworld")
 def main(args):
     banner_execute()
 
@@ -46,36 +170,40 @@ def main(args):
     if not dir_exists(args.target_dir):
         return -1
 
-    # The game directory, e.g: c:\RimWorld
-    if not dir_exists(args.rimworld_dir):
-        return -1
+    # The game directories, e.g: c:\RimWorld
+    rimworld_dirs = [args.rimworld_dir] + args.extra_rimworld_dirs
+    for rimworld_dir in rimworld_dirs:
+        if not dir_exists(rimworld_dir):
+            return -1
 
     # for ex.: <my_repo>\output\PrepareLanding
     # location where the whole mod is (with \About, \Assemblies, \Languages,
     #  etc.)
-    if not dir_exists(args.output_dir):
+    if args.output_dir and not dir_exists(args.output_dir):
         return -1
 
     # TODO: pass MOD_NAME in args?
 
-    # The game directory, e.g: c:\RimWorld
-    rimworld_dir = pathlib.Path(args.rimworld_dir)
-    # e.g: c:\RimWorld\Mods
-    rimworld_mods_dir = rimworld_dir.joinpath(RIMWORLD_MOD_DIR)
-    # e.g: c:\RimWorld\Mods\PrepareLanding
-    mod_dir = rimworld_mods_dir.joinpath(MOD_NAME)
-
-    if not dir_exists(mod_dir):
-        print("Provided mod path '{}' doesn't exists or is not a directory."
-              .format(mod_dir), file=sys.stderr)
-        print("Trying to create it", file=sys.stderr)
-        try:
-            os.makedirs(mod_dir)
-        except OSError as e:
-            if e.errno != errno.EEXIST:
-                print("Couldn't create directory '{}'.".format(mod_dir), file=sys.stderr)
-                return -1
-
+    mod_dirs = list()
+    for rimworld_dir in rimworld_dirs:
+        # e.g: c:\RimWorld\Mods\PrepareLanding
+        mod_dir = pathlib.Path(rimworld_dir).joinpath(
+            RIMWORLD_MOD_DIR, MOD_NAME)
+        if mod_dir in mod_dirs:
+            continue
+
+        if not dir_exists(mod_dir):
+            print("Provided mod path '{}' doesn't exists or is not a "
+                  "directory.".format(mod_dir), file=sys.stderr)
+            print("Trying to create it", file=sys.stderr)
+            try:
+                os.makedirs(str(mod_dir))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    print("Couldn't create directory '{}'.".format(mod_dir),
+                          file=sys.stderr)
+                    return -1
+        mod_dirs.append(mod_dir)
 
     # check that we have an output dir
     if args.output_dir:
@@ -88,58 +216,59 @@ def main(args):
         if args.mdb:
             file_types.append('*.mdb')
 
-        # e.g: <my_repo>\output\PrepareLanding\Assemblies
-        output_dir = pathlib.Path(args.output_dir).joinpath(f'{args.rimworld_ver}\\{MOD_ASSEMBLIES}')
-        # make sure there's an 'Assemblies' dir in output dir
-        if not dir_exists(output_dir):
-            print("Wasn't able to find the following directory: {}"
-                  .format(output_dir), file=sys.stderr)
+        # the build targets a single version (it's compiled against its
+        #  libs); the other versions are deployed as they are.
+        build_ver = args.build_ver or args.rimworld_vers[0]
+        if build_ver not in args.rimworld_vers:
+            print("Build version '{}' is not one of the RimWorld versions: {}"
+                  .format(build_ver, ", ".join(args.rimworld_vers)),
+                  file=sys.stderr)
             return -1
 
-        # copy from target_dir to output_dir
-        print("Trying to copy binary files.")
-        target_dir = pathlib.Path(args.target_dir)
-        for file_type in file_types:
-            for file_name in target_dir.glob(file_type):
-                try:
-                    shutil.copy2(file_name, str(output_dir))
-                    if args.verbose:
-                        print("Copied:\n\t- from: '{}'\n\t- to '{}'"
-                              .format(file_name, output_dir))
-                except Exception as err:
-                    print("An error occured while trying to copy a file.\n"
-                          "src: {}\ndst: {}\nThe error was: {}"
-                          .format(file_name, output_dir, err),
-                          file=sys.stderr)
-                    return -1
+        # e.g: <my_repo>\output\PrepareLanding\1.3\Assemblies
+        output_dir = pathlib.Path(args.output_dir)
+        for rimworld_ver in args.rimworld_vers:
+            assemblies_dir = output_dir.joinpath(rimworld_ver, MOD_ASSEMBLIES)
+            # make sure there's an 'Assemblies' dir in output dir
+            if not dir_exists(assemblies_dir):
+                print("Wasn't able to find the following directory: {}"
+                      .format(assemblies_dir), file=sys.stderr)
+                return -1
+
+        # copy from target_dir to the output_dir of the build version
+        print("Trying to copy binary files to version {}.".format(build_ver))
+        plan = plan_binaries(
+            pathlib.Path(args.target_dir),
+            output_dir.joinpath(build_ver, MOD_ASSEMBLIES), file_types)
+        with stage_timings.stage("binaries") as stage:
+            if not execute_plan(plan, args.jobs, args.verbose, stage):
+                return -1
 
     # now, delete the whole folder mod in RimWorld. Catch any errors so we
     #  get out if anything goes really wrong (e.g unable to remove some files
     #  due to a lock).
-    try:
-        shutil.rmtree(str(mod_dir))
-    except Exception as err:
-        print("An error occurred while trying to remove the following "
-              "directory:\n\t{}\nThe error was:\n\t{}".format(mod_dir, err),
-              file=sys.stderr)
-        return -1
+    with stage_timings.stage("clean"):
+        for mod_dir in mod_dirs:
+            try:
+                shutil.rmtree(str(mod_dir))
+            except Exception as err:
+                print("An error occurred while trying to remove the "
+                      "following directory:\n\t{}\nThe error was:\n\t{}"
+                      .format(mod_dir, err), file=sys.stderr)
+                return -1
 
     # copy the whole mod content to RimWorld
-    print("Trying to copy the whole mod to its destination.")
-    src_dir = args.output_dir if args.output_dir else args.target_dir
-    try:
-        shutil.copytree(src_dir, str(mod_dir))
-        if args.verbose:
-            print("Copied:\n\t- from: '{}'\n\t- to '{}'"
-                  .format(src_dir, mod_dir))
-    except Exception as err:
-        print("An error occurred while trying to copy a directory.\n"
-              "src dir: {}\n"
-              "dst dir: {}\n"
-              "The error was:{}".format(src_dir, mod_dir, err), file=sys.stderr)
-        return -1
+    print("Trying to copy the whole mod to its destination(s).")
+    src_dir = pathlib.Path(
+        args.output_dir if args.output_dir else args.target_dir)
+    with stage_timings.stage("deploy") as stage:
+        plan = plan_deploy(src_dir, mod_dirs)
+        if not execute_plan(plan, args.jobs, args.verbose, stage):
+            return -1
 
-    print("Successfully copied the mod to its folder: '{}'.".format(mod_dir))
+    for mod_dir in mod_dirs:
+        print("Successfully copied the mod to its folder: '{}'."
+              .format(mod_dir))
 
     return 0
 
@@ -157,8 +286,19 @@ if __name__ == "__main__":
         help="Full path to RimWorld game folder.")
 
     arg_parser.add_argument(
-        'rimworld_ver', action="store",
-        help="Rimworld version (e.g. '1.2').")
+        'rimworld_vers', action="store", nargs='+', metavar='rimworld_ver',
+        help="One or more Rimworld versions (e.g. '1.2' '1.3').")
+
+    arg_parser.add_argument(
+        '-b', '--build_ver', action="store", dest="build_ver",
+        help="Rimworld version the binaries in target_dir were built for; "
+             "only this version gets them. [default: first rimworld_ver]")
+
+    arg_parser.add_argument(
+        '-r', '--extra_rimworld_dir', action="append",
+        dest="extra_rimworld_dirs", default=[],
+        help="Full path to another RimWorld game folder where the mod is "
+             "also deployed. Can be repeated.")
 
     # output dir and target_dir might be the same, so this one is optional
     arg_parser.add_argument(
@@ -180,5 +320,10 @@ if __name__ == "__main__":
         '--verbose', action="store_true", dest="verbose", default=True,
         help="Verbose script. [default: True]")
 
+    arg_parser.add_argument(
+        '-j', '--jobs', action="store", type=int, dest="jobs",
+        default=os.cpu_count() or 1,
+        help="Number of files copied concurrently. [default: CPU count]")
+
     parsed_args = arg_parser.parse_args()
     sys.exit(main(parsed_args))
@@ -0,0 +1,32 @@
+#!/usr/bin/python3.6
+# -*- coding: UTF-8 -*-
+import json
+import os
+import pathlib
+import sys
+
+# Location of the tools caches.
+CACHE_DIR = pathlib.Path(os.path.realpath(__file__)).parent.joinpath(".cache")
+
+
+def load(cache_file: pathlib.Path) -> dict:
+    """Load a cache file; a missing or unreadable cache is an empty one."""
+    if not cache_file.exists():
+        return dict()
+    try:
+        with open(str(cache_file), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as err:
+        print("Couldn't read cache file '{}', ignoring it. The error was: {}"
+              .format(cache_file, err), file=sys.stderr)
+        return dict()
+
+
+def save(cache_file: pathlib.Path, cache: dict):
+    try:
+        os.makedirs(str(cache_file.parent), exist_ok=True)
+        with open(str(cache_file), "w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+    except OSError as err:
+        print("Couldn't write cache file '{}'. The error was: {}"
+              .format(cache_file, err), file=sys.stderr)
@@ -0,0 +1,451 @@
+#!/usr/bin/python3.6
+# -*- coding: UTF-8 -*-
+import argparse
+import hashlib
+import os
+import pathlib
+import struct
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+import json_cache
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Chunks kept in the optimized file. Everything else (text, time, physical
+# dimensions, significant bits, etc.) is metadata that doesn't change the
+# rendered pixels.
+KEPT_CHUNKS = {b"IHDR", b"PLTE", b"tRNS", b"IDAT", b"IEND",
+               b"gAMA", b"cHRM", b"sRGB", b"iCCP"}
+
+# Chunks that make the color type conversions unsafe (they describe the
+# pixels in the current color type).
+COLOR_SPACE_CHUNKS = {b"tRNS", b"iCCP"}
+
+# color type -> number of channels
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# Size of the IDAT chunks written in the optimized file.
+IDAT_SIZE = 1 << 16
+
+# Default location of the cache file.
+DEFAULT_CACHE_FILE = json_cache.CACHE_DIR.joinpath("optimize_textures.json")
+
+
+class PngError(Exception):
+    pass
+
+
+class Png(object):
+    """A decoded 8-bit, non-interlaced PNG image."""
+
+    def __init__(self, width: int, height: int, color_type: int,
+                 rows: List[bytes], palette: Optional[bytes] = None,
+                 transparency: Optional[bytes] = None):
+        self.width = width
+        self.height = height
+        self.color_type = color_type
+        self.rows = rows
+        self.palette = palette
+        self.transparency = transparency
+
+    @property
+    def bpp(self) -> int:
+        return CHANNELS[self.color_type]
+
+    def rgba_rows(self) -> List[bytes]:
+        rgba = list()
+        for row in self.rows:
+            if self.color_type == 6:
+                rgba.append(bytes(row))
+                continue
+
+            out = bytearray(self.width * 4)
+            for x in range(self.width):
+                if self.color_type == 0:
+                    value = row[x]
+                    out[x * 4:x * 4 + 4] = (value, value, value, 255)
+                elif self.color_type == 2:
+                    out[x * 4:x * 4 + 3] = row[x * 3:x * 3 + 3]
+                    out[x * 4 + 3] = 255
+                elif self.color_type == 4:
+                    value = row[x * 2]
+                    out[x * 4:x * 4 + 4] = (value, value, value,
+                                            row[x * 2 + 1])
+                else:
+                    index = row[x]
+                    out[x * 4:x * 4 + 3] = self.palette[index * 3:
+                                                        index * 3 + 3]
+                    trns = self.transparency or b""
+                    out[x * 4 + 3] = trns[index] if index < len(trns) else 255
+            rgba.append(bytes(out))
+        return rgba
+
+
+def read_chunks(data: bytes) -> List[Tuple[bytes, bytes]]:
+    if not data.startswith(PNG_SIGNATURE):
+        raise PngError("Not a PNG file.")
+
+    chunks = list()
+    offset = len(PNG_SIGNATURE)
+    while offset < len(data):
+        if offset + 8 > len(data):
+            raise PngError("Truncated chunk header.")
+        length, chunk_type = struct.unpack(">I4s", data[offset:offset + 8])
+        chunk_data = data[offset + 8:offset + 8 + length]
+        if len(chunk_data) != length:
+            raise PngError("Truncated '{}' chunk.".format(
+                chunk_type.decode("latin-1")))
+        chunks.append((chunk_type, chunk_data))
+        offset += 12 + length
+        if chunk_type == b"IEND":
+            break
+
+    return chunks
+
+
+def write_chunk(chunk_type: bytes, chunk_data: bytes) -> bytes:
+    crc = zlib.crc32(chunk_data, zlib.crc32(chunk_type)) & 0xffffffff
+    return struct.pack(">I4s", len(chunk_data), chunk_type) + chunk_data + \
+        struct.pack(">I", crc)
+
+
+def paeth(a: int, b: int, c: int) -> int:
+    p = a + b - c
+    pa = abs(p - a)
+    pb = abs(p - b)
+    pc = abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    if pb <= pc:
+        return b
+    return c
+
+
+def unfilter(raw: bytes, height: int, stride: int, bpp: int) -> List[bytes]:
+    rows = list()
+    previous = bytearray(stride)
+    offset = 0
+    for _ in range(height):
+        filter_type = raw[offset]
+        row = bytearray(raw[offset + 1:offset + 1 + stride])
+        offset += 1 + stride
+        if filter_type == 1:
+            for i in range(bpp, stride):
+                row[i] = (row[i] + row[i - bpp]) & 0xff
+        elif filter_type == 2:
+            for i in range(stride):
+                row[i] = (row[i] + previous[i]) & 0xff
+        elif filter_type == 3:
+            for i in range(stride):
+                left = row[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xff
+        elif filter_type == 4:
+            for i in range(stride):
+                left = row[i - bpp] if i >= bpp else 0
+                up_left = previous[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + paeth(left, previous[i], up_left)) & 0xff
+        elif filter_type != 0:
+            raise PngError("Unknown filter type {}.".format(filter_type))
+        rows.append(bytes(row))
+        previous = row
+
+    return rows
+
+
+def filter_row(filter_type: int, row: bytes, previous: bytes,
+               bpp: int) -> bytes:
+    if filter_type == 0:
+        return row
+
+    out = bytearray(len(row))
+    for i in range(len(row)):
+        left = row[i - bpp] if i >= bpp else 0
+        if filter_type == 1:
+            predictor = left
+        elif filter_type == 2:
+            predictor = previous[i]
+        elif filter_type == 3:
+            predictor = (left + previous[i]) >> 1
+        else:
+            predictor = paeth(left, previous[i],
+                              previous[i - bpp] if i >= bpp else 0)
+        out[i] = (row[i] - predictor) & 0xff
+    return bytes(out)
+
+
+def filter_rows(rows: List[bytes], bpp: int, adaptive: bool) -> bytes:
+    """Adaptive: minimum sum of absolute differences filter per row (PNG
+    spec heuristic); otherwise no filter (usually better for palettes)."""
+    out = bytearray()
+    previous = bytes(len(rows[0])) if rows else b""
+    for row in rows:
+        if not adaptive:
+            out.append(0)
+            out += row
+            continue
+
+        best = None
+        for filter_type in range(5):
+            filtered = filter_row(filter_type, row, previous, bpp)
+            cost = sum(value if value < 128 else 256 - value
+                       for value in filtered)
+            if best is None or cost < best[0]:
+                best = (cost, filter_type, filtered)
+        out.append(best[1])
+        out += best[2]
+        previous = row
+
+    return bytes(out)
+
+
+def decode(chunks: List[Tuple[bytes, bytes]]) -> Optional[Png]:
+    """Returns None if re-filtering isn't supported (not 8-bit, interlaced)."""
+    width, height, bit_depth, color_type, _, _, interlace = struct.unpack(
+        ">IIBBBBB", chunks[0][1])
+    if bit_depth != 8 or interlace != 0 or color_type not in CHANNELS:
+        return None
+
+    chunk_map = dict(chunks)
+    bpp = CHANNELS[color_type]
+    raw = zlib.decompress(b"".join(data for chunk_type, data in chunks
+                                   if chunk_type == b"IDAT"))
+    rows = unfilter(raw, height, width * bpp, bpp)
+    return Png(width, height, color_type, rows, chunk_map.get(b"PLTE"),
+               chunk_map.get(b"tRNS"))
+
+
+def reduce_color_type(png: Png) -> List[Png]:
+    """Return the lossless color type reductions of an RGB(A) image."""
+    if png.color_type not in (2, 6):
+        return list()
+
+    candidates = list()
+    bpp = png.bpp
+    opaque = png.color_type == 2 or all(
+        row[x] == 255 for row in png.rows for x in range(3, len(row), 4))
+
+    if png.color_type == 6 and opaque:
+        candidates.append(Png(png.width, png.height, 2, [
+            bytes(value for i, value in enumerate(row) if i % 4 != 3)
+            for row in png.rows]))
+
+    colors = dict()
+    for row in png.rows:
+        for x in range(0, len(row), bpp):
+            color = row[x:x + bpp]
+            if color not in colors:
+                if len(colors) == 256:
+                    return candidates
+                colors[color] = None
+
+    # translucent colors first so the tRNS chunk stays as short as possible.
+    palette_colors = sorted(
+        colors, key=lambda c: (255 if bpp == 3 else c[3]) == 255)
+    indices = {color: index for index, color in enumerate(palette_colors)}
+    palette = b"".join(color[:3] for color in palette_colors)
+    transparency = bytes(color[3] for color in palette_colors
+                         if bpp == 4 and color[3] != 255) or None
+    rows = [bytes(indices[row[x:x + bpp]] for x in range(0, len(row), bpp))
+            for row in png.rows]
+    candidates.append(Png(png.width, png.height, 3, rows, palette,
+                          transparency))
+    return candidates
+
+
+def compress(data: bytes) -> bytes:
+    best = None
+    for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        compressed = compressor.compress(data) + compressor.flush()
+        if best is None or len(compressed) < len(best):
+            best = compressed
+    return best
+
+
+def encode(png: Png, extra_chunks: List[Tuple[bytes, bytes]],
+           idat: bytes) -> bytes:
+    out = bytearray(PNG_SIGNATURE)
+    out += write_chunk(b"IHDR", struct.pack(
+        ">IIBBBBB", png.width, png.height, 8, png.color_type, 0, 0, 0))
+    # color space chunks must come before PLTE.
+    for chunk_type, chunk_data in extra_chunks:
+        out += write_chunk(chunk_type, chunk_data)
+    if png.color_type == 3:
+        out += write_chunk(b"PLTE", png.palette)
+    if png.transparency:
+        out += write_chunk(b"tRNS", png.transparency)
+    for offset in range(0, len(idat), IDAT_SIZE):
+        out += write_chunk(b"IDAT", idat[offset:offset + IDAT_SIZE])
+    out += write_chunk(b"IEND", b"")
+    return bytes(out)
+
+
+def optimize_png(data: bytes) -> bytes:
+    """Returns the smallest lossless encoding (maybe the original data)."""
+    try:
+        return _optimize_png(data)
+    except (struct.error, IndexError, KeyError, ValueError, zlib.error) as err:
+        # e.g. short IHDR, truncated scanlines, bad palette indices.
+        raise PngError("Malformed PNG file ({}: {}).".format(
+            type(err).__name__, err))
+
+
+def _optimize_png(data: bytes) -> bytes:
+    chunks = read_chunks(data)
+    if not chunks or chunks[0][0] != b"IHDR":
+        raise PngError("Missing IHDR chunk.")
+
+    chunk_types = {chunk_type for chunk_type, _ in chunks}
+    extra_chunks = [(chunk_type, chunk_data)
+                    for chunk_type, chunk_data in chunks
+                    if chunk_type in KEPT_CHUNKS - {b"IHDR", b"PLTE", b"tRNS",
+                                                    b"IDAT", b"IEND"}]
+    png = decode(chunks)
+    if png is None:
+        # unsupported for re-filtering: strip metadata and recompress the
+        # already filtered data.
+        idat = b"".join(chunk_data for chunk_type, chunk_data in chunks
+                        if chunk_type == b"IDAT")
+        stripped = bytearray(PNG_SIGNATURE)
+        for chunk_type, chunk_data in chunks:
+            if chunk_type == b"IDAT":
+                if idat:
+                    stripped += write_chunk(
+                        b"IDAT", compress(zlib.decompress(idat)))
+                    idat = b""
+            elif chunk_type in KEPT_CHUNKS:
+                stripped += write_chunk(chunk_type, chunk_data)
+        return min(data, bytes(stripped), key=len)
+
+    candidates = [png]
+    if not chunk_types & COLOR_SPACE_CHUNKS:
+        candidates.extend(reduce_color_type(png))
+
+    best = data
+    for candidate in candidates:
+        for adaptive in (False, True):
+            if adaptive and candidate.color_type == 3:
+                continue
+            encoded = encode(candidate, extra_chunks, compress(
+                filter_rows(candidate.rows, candidate.bpp, adaptive)))
+            if len(encoded) < len(best):
+                best = encoded
+
+    if best is not data:
+        # make sure the pixels are exactly the same.
+        optimized = decode(read_chunks(best))
+        if optimized.rgba_rows() != png.rgba_rows():
+            raise PngError("Optimized image differs from the original.")
+
+    return best
+
+
+def optimize_file(path: str) -> Tuple[int, int, str]:
+    """Returns the original size, the new size and the new content hash."""
+    file_path = pathlib.Path(path)
+    data = file_path.read_bytes()
+    optimized = optimize_png(data)
+    if len(optimized) < len(data):
+        file_path.write_bytes(optimized)
+    return len(data), len(optimized), hashlib.sha256(optimized).hexdigest()
+
+
+def banner_execute() -> pathlib.Path:
+    script_path = pathlib.Path(os.path.realpath(__file__))
+    sep = "-" * 79
+    print("{}\nExecuting: {}\n{}".format(sep, script_path.name, sep))
+    return script_path
+
+
+def main(args):
+    banner_execute()
+
+    png_files = list()
+    for path_str in args.paths:
+        path = pathlib.Path(path_str)
+        if path.is_dir():
+            png_files.extend(sorted(
+                p for p in path.rglob("*") if p.suffix.lower() == ".png"))
+        elif path.is_file():
+            png_files.append(path)
+        else:
+            print("Provided path '{}' doesn't exists.".format(path_str),
+                  file=sys.stderr)
+            return -1
+
+    cache_file = pathlib.Path(args.cache_file)
+    # hash of an already optimized file content -> its size
+    cache = dict() if args.no_cache else json_cache.load(cache_file)
+
+    pending = list()
+    skipped = 0
+    for png_file in png_files:
+        digest = hashlib.sha256(png_file.read_bytes()).hexdigest()
+        if digest in cache:
+            skipped += 1
+            if args.verbose:
+                print("{}: already optimized (cached).".format(png_file))
+            continue
+        pending.append(png_file)
+
+    total_before = total_after = 0
+    errors = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [(png_file, executor.submit(optimize_file, str(png_file)))
+                   for png_file in pending]
+        for png_file, future in futures:
+            try:
+                before, after, digest = future.result()
+            except Exception as err:
+                # one bad file must not stop the others (nor lose the cache).
+                print("{}: couldn't be optimized. The error was: {}"
+                      .format(png_file, err), file=sys.stderr)
+                errors += 1
+                continue
+
+            cache[digest] = after
+            total_before += before
+            total_after += after
+            print("{}: {} -> {} bytes ({} bytes saved).".format(
+                png_file, before, after, before - after))
+
+    if not args.no_cache:
+        json_cache.save(cache_file, cache)
+
+    print("{} file(s) optimized, {} file(s) skipped (cached), {} byte(s) "
+          "saved.".format(len(pending) - errors, skipped,
+                          total_before - total_after))
+
+    return -1 if errors else 0
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Losslessly recompress PNG files in place (palette "
+                    "reduction, better deflate, metadata stripping).")
+
+    arg_parser.add_argument(
+        'paths', action="store", nargs='+',
+        help="PNG files or directories (searched recursively) to optimize.")
+
+    arg_parser.add_argument(
+        '-c', '--cache_file', action="store", default=str(DEFAULT_CACHE_FILE),
+        help="Cache file path. [default: tools/.cache/optimize_textures.json]")
+
+    arg_parser.add_argument(
+        '--no_cache', action="store_true", default=False,
+        help="Don't read or write the cache. [default: False]")
+
+    arg_parser.add_argument(
+        '-j', '--jobs', action="store", type=int, dest="jobs",
+        default=os.cpu_count() or 1,
+        help="Number of files processed concurrently. [default: CPU count]")
+
+    arg_parser.add_argument(
+        '--verbose', action="store_true", dest="verbose", default=False,
+        help="Verbose script. [default: False]")
+
+    parsed_args = arg_parser.parse_args()
+    sys.exit(main(parsed_args))
@@ -5,7 +5,9 @@ import argparse
 import os
 import pathlib
 import sys
-import subprocess
+
+import stage_timings
+import tool_runner
 
 
 def banner_execute() -> pathlib.Path:
@@ -31,11 +33,13 @@ def file_exists(path_str: pathlib, check_absolute: bool = False) -> bool:
     return True
 
 
+@stage_timings.record("pdb2mdb")
 def main(args):
     script_path = banner_execute()
 
-    if not file_exists(args.dll_path, True):
-        return -1
+    for dll_path in args.dll_paths:
+        if not file_exists(dll_path, True):
+            return -1
 
     pdb2mdb_path = "pdb2mdb"
     if args.bin_path:
@@ -47,31 +51,56 @@ def main(args):
         pdb2mdb_path = str(script_path.parent.joinpath(pdb2mdb_path))
 
     print("pdb2mdb binary path: '{}'".format(pdb2mdb_path))
-    print("Generating mdb file")
+    print("Generating mdb file(s)")
 
-    # run pdb2mdb
-    process = subprocess.run([pdb2mdb_path, args.dll_path],
-                             stdout=subprocess.PIPE)
-    if process.stdout != b'':
-        print(process.stdout)
-
-    if process.returncode != 0:
-        print("An error occured from pdb2mdb. Return code: {}".format(
-            process.returncode), file=sys.stderr)
-    else:
-        print("pdb2mdb success. Return code: {}".format(process.returncode))
+    commands = list()
+    for dll_path in args.dll_paths:
+        commands.append(tool_runner.ToolCommand(
+            [pdb2mdb_path, dll_path], os.path.basename(dll_path),
+            args.timeout))
 
-    # return pdb2mdb return code to caller.
-    return process.returncode
+    # run pdb2mdb
+    with stage_timings.stage("pdb2mdb") as stage:
+        stage.bytes = sum(os.path.getsize(p) for p in args.dll_paths)
+        results = tool_runner.run(tool_runner.run_tools(commands, args.jobs))
+
+    return_code = 0
+    for result in results:
+        if result.error:
+            print("Couldn't run pdb2mdb. The error was: {}".format(
+                result.error), file=sys.stderr)
+            return_code = return_code or -1
+        elif result.timed_out:
+            print("pdb2mdb timed out after {:.0f}s on '{}'.".format(
+                result.command.timeout, result.command.name),
+                file=sys.stderr)
+            return_code = return_code or -1
+        elif result.return_code != 0:
+            print("An error occured from pdb2mdb on '{}'. Return code: {}"
+                  .format(result.command.name, result.return_code),
+                  file=sys.stderr)
+            return_code = return_code or result.return_code
+        else:
+            print("pdb2mdb success on '{}'. Return code: {}".format(
+                result.command.name, result.return_code))
+
+    # return the first pdb2mdb error code (if any) to caller.
+    return return_code
 
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser(description='Pdb2mdb starter script.')
     arg_parser.add_argument(
-        'dll_path', type=str, action="store",
-        help='Full path to the DLL for which to generate the mdb file')
+        'dll_paths', type=str, action="store", nargs='+', metavar='dll_path',
+        help='Full path to the DLL(s) for which to generate the mdb file')
     arg_parser.add_argument(
         '-p', action="store", dest="bin_path",
         help="Full path to pdb2mdb (default: use current dir)")
+    arg_parser.add_argument(
+        '-t', '--timeout', action="store", type=float,
+        help="Timeout (in seconds) for each DLL. (default: no timeout)")
+    arg_parser.add_argument(
+        '-j', '--jobs', action="store", type=int, default=os.cpu_count() or 1,
+        help="Number of DLLs processed concurrently (default: CPU count)")
 
     parsed_args = arg_parser.parse_args()
     sys.exit(main(parsed_args))
@@ -0,0 +1,434 @@
+#!/usr/bin/python3.6
+# -*- coding: UTF-8 -*-
+import argparse
+import hashlib
+import io
+import json
+import lzma
+import os
+import pathlib
+import shutil
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Dict
+
+# Version of the delta file format.
+DELTA_FORMAT = 1
+
+# Name of the manifest in a delta file.
+MANIFEST_NAME = "manifest.json"
+
+# Size of the blocks indexed in the old file when diffing.
+BLOCK_SIZE = 32
+
+# Patch opcodes: copy a range from the old file / insert literal bytes.
+OP_COPY = b"C"
+OP_INSERT = b"I"
+
+
+class DeltaError(Exception):
+    pass
+
+
+def banner_execute() -> pathlib.Path:
+    script_path = pathlib.Path(os.path.realpath(__file__))
+    sep = "-" * 79
+    print("{}\nExecuting: {}\n{}".format(sep, script_path.name, sep))
+    return script_path
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def load_artifact(path: pathlib.Path) -> Dict[str, bytes]:
+    """Load all the files of a release artifact.
+
+    The artifact is either a zip file or a mod directory. For a zip file, the
+    top directory (e.g. 'PrepareLanding/') is stripped if all the files are in
+    it, so paths are always relative to the mod directory.
+    """
+    files = dict()
+    if path.is_dir():
+        for file_path in sorted(path.rglob("*")):
+            if file_path.is_file():
+                files[file_path.relative_to(path).as_posix()] = \
+                    file_path.read_bytes()
+        return files
+
+    if not zipfile.is_zipfile(str(path)):
+        raise DeltaError("'{}' is neither a directory nor a zip file."
+                         .format(path))
+
+    with zipfile.ZipFile(str(path), "r") as archive:
+        for info in archive.infolist():
+            if not info.is_dir():
+                files[info.filename.replace("\\", "/")] = archive.read(info)
+
+    top_dirs = {name.split("/", 1)[0] for name in files}
+    if len(top_dirs) == 1 and all("/" in name for name in files):
+        prefix = top_dirs.pop() + "/"
+        files = {name[len(prefix):]: data for name, data in files.items()}
+
+    return files
+
+
+def diff(old: bytes, new: bytes) -> bytes:
+    """Compute a binary patch that rebuilds `new` from `old`.
+
+    The old file is indexed by aligned blocks, then the new file is scanned
+    byte by byte looking for those blocks; matches are extended as far as
+    possible and become copies, everything else is inserted as is.
+    """
+    index = dict()
+    for offset in range(0, len(old) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        index.setdefault(old[offset:offset + BLOCK_SIZE], offset)
+
+    out = io.BytesIO()
+    literal_start = 0
+    position = 0
+    end = len(new) - BLOCK_SIZE + 1
+    while position < end:
+        old_offset = index.get(new[position:position + BLOCK_SIZE])
+        if old_offset is None:
+            position += 1
+            continue
+
+        # extend the match backward (into the pending literal)...
+        start = position
+        while start > literal_start and old_offset > 0 and \
+                new[start - 1] == old[old_offset - 1]:
+            start -= 1
+            old_offset -= 1
+        # ... and forward.
+        length = position - start + BLOCK_SIZE
+        limit = min(len(new) - start, len(old) - old_offset)
+        while length + 256 <= limit and \
+                new[start + length:start + length + 256] == \
+                old[old_offset + length:old_offset + length + 256]:
+            length += 256
+        while length < limit and \
+                new[start + length] == old[old_offset + length]:
+            length += 1
+
+        if start > literal_start:
+            out.write(OP_INSERT + struct.pack("<I", start - literal_start))
+            out.write(new[literal_start:start])
+        out.write(OP_COPY + struct.pack("<II", old_offset, length))
+        position = literal_start = start + length
+
+    if literal_start < len(new):
+        out.write(OP_INSERT + struct.pack("<I", len(new) - literal_start))
+        out.write(new[literal_start:])
+
+    return lzma.compress(out.getvalue())
+
+
+def patch(old: bytes, patch_data: bytes) -> bytes:
+    """Apply a patch made by `diff`."""
+    ops = memoryview(lzma.decompress(patch_data))
+    out = io.BytesIO()
+    position = 0
+    while position < len(ops):
+        opcode = bytes(ops[position:position + 1])
+        if opcode == OP_COPY:
+            offset, length = struct.unpack_from("<II", ops, position + 1)
+            out.write(old[offset:offset + length])
+            position += 9
+        elif opcode == OP_INSERT:
+            length, = struct.unpack_from("<I", ops, position + 1)
+            out.write(ops[position + 5:position + 5 + length])
+            position += 5 + length
+        else:
+            raise DeltaError("Unknown patch opcode {!r}.".format(opcode))
+
+    return out.getvalue()
+
+
+def create_delta(old_files: Dict[str, bytes], new_files: Dict[str, bytes],
+                 delta_path: pathlib.Path) -> Dict[str, int]:
+    """Write the delta between two artifacts.
+
+    Returns the number of files per method ('full', 'patch', 'unchanged',
+    'removed').
+    """
+    manifest = {
+        "format": DELTA_FORMAT,
+        "old": {name: sha256(data) for name, data in old_files.items()},
+        "new": {name: sha256(data) for name, data in new_files.items()},
+        "files": dict(),
+        "removed": sorted(set(old_files) - set(new_files)),
+    }
+    stats = {"full": 0, "patch": 0, "unchanged": 0,
+             "removed": len(manifest["removed"])}
+
+    # the members are already compressed, so they are stored as is.
+    with zipfile.ZipFile(str(delta_path), "w", zipfile.ZIP_STORED) as delta:
+        for name, data in sorted(new_files.items()):
+            if name in old_files and \
+                    manifest["old"][name] == manifest["new"][name]:
+                stats["unchanged"] += 1
+                continue
+
+            full = lzma.compress(data)
+            method, member = "full", full
+            if name in old_files:
+                patch_data = diff(old_files[name], data)
+                if len(patch_data) < len(full):
+                    method, member = "patch", patch_data
+
+            manifest["files"][name] = method
+            stats[method] += 1
+            delta.writestr("{}/{}".format(method, name), member)
+
+        delta.writestr(MANIFEST_NAME, json.dumps(manifest, indent=1,
+                                                 sort_keys=True))
+
+    return stats
+
+
+def write_file(path: pathlib.Path, data: bytes):
+    """Write a file atomically (so a failure doesn't leave a partial file)."""
+    os.makedirs(str(path.parent), exist_ok=True)
+    tmp_path = path.with_name(path.name + ".delta-tmp")
+    tmp_path.write_bytes(data)
+    os.replace(str(tmp_path), str(path))
+
+
+def remove_empty_dirs(mod_dir: pathlib.Path, names):
+    """Remove the directories left empty by the removed files."""
+    for name in names:
+        parent = mod_dir.joinpath(name).parent
+        while parent != mod_dir:
+            try:
+                os.rmdir(str(parent))
+            except OSError:
+                # not empty (or already gone).
+                break
+            parent = parent.parent
+
+
+def check_names(mod_dir: pathlib.Path, manifest: dict):
+    """Make sure every file name of a manifest stays inside the mod
+    directory (no absolute path, no '..', no escaping symlink)."""
+    root = mod_dir.resolve()
+    names = set(manifest["old"]) | set(manifest["new"]) | \
+        set(manifest["files"]) | set(manifest["removed"])
+    for name in names:
+        posix_name = pathlib.PurePosixPath(name)
+        windows_name = pathlib.PureWindowsPath(name)
+        if not name or posix_name.is_absolute() or windows_name.drive or \
+                windows_name.root or ".." in windows_name.parts:
+            raise DeltaError("Invalid file name in delta: '{}'.".format(name))
+        if root not in mod_dir.joinpath(name).resolve().parents:
+            raise DeltaError("File name '{}' is outside of '{}'."
+                             .format(name, mod_dir))
+
+    for name, method in manifest["files"].items():
+        if method not in ("full", "patch") or name not in manifest["new"]:
+            raise DeltaError("Invalid entry in delta: '{}' ({})."
+                             .format(name, method))
+
+
+def apply_delta(mod_dir: pathlib.Path, delta_path: pathlib.Path) \
+        -> Dict[str, int]:
+    """Rebuild the new mod folder in place from the old one and a delta.
+
+    Returns the number of files per method ('full', 'patch', 'unchanged',
+    'removed').
+    """
+    with zipfile.ZipFile(str(delta_path), "r") as delta:
+        manifest = json.loads(delta.read(MANIFEST_NAME).decode("utf-8"))
+        if manifest.get("format") != DELTA_FORMAT:
+            raise DeltaError("Unsupported delta format: {}."
+                             .format(manifest.get("format")))
+
+        # validate all the names before reading or writing anything.
+        check_names(mod_dir, manifest)
+
+        # check that the mod folder is the one the delta was made from.
+        for name, digest in manifest["old"].items():
+            file_path = mod_dir.joinpath(name)
+            if not file_path.is_file():
+                raise DeltaError("Missing file: '{}'.".format(file_path))
+            if sha256(file_path.read_bytes()) != digest:
+                raise DeltaError("'{}' doesn't match the delta base version."
+                                 .format(file_path))
+
+        # build everything in memory first: nothing is written if a member
+        # can't be rebuilt.
+        new_contents = list()
+        for name, method in sorted(manifest["files"].items()):
+            member = delta.read("{}/{}".format(method, name))
+            if method == "patch":
+                data = patch(mod_dir.joinpath(name).read_bytes(), member)
+            else:
+                data = lzma.decompress(member)
+            if sha256(data) != manifest["new"][name]:
+                raise DeltaError("Rebuilt '{}' doesn't match its hash."
+                                 .format(name))
+            new_contents.append((name, data))
+
+    for name, data in new_contents:
+        write_file(mod_dir.joinpath(name), data)
+    for name in manifest["removed"]:
+        os.remove(str(mod_dir.joinpath(name)))
+    remove_empty_dirs(mod_dir, manifest["removed"])
+
+    # final check of the whole new version.
+    for name, digest in manifest["new"].items():
+        if sha256(mod_dir.joinpath(name).read_bytes()) != digest:
+            raise DeltaError("'{}' doesn't match the new version hash."
+                             .format(name))
+
+    stats = {"full": 0, "patch": 0, "removed": len(manifest["removed"])}
+    for method in manifest["files"].values():
+        stats[method] += 1
+    stats["unchanged"] = len(manifest["new"]) - len(manifest["files"])
+    return stats
+
+
+def print_stats(stats: Dict[str, int]):
+    print("Files: {unchanged} unchanged, {patch} patched, {full} full, "
+          "{removed} removed.".format(**stats))
+
+
+def write_artifact(files: Dict[str, bytes], dest_dir: pathlib.Path):
+    for name, data in files.items():
+        file_path = dest_dir.joinpath(name)
+        os.makedirs(str(file_path.parent), exist_ok=True)
+        file_path.write_bytes(data)
+
+
+def artifact_size(path: pathlib.Path) -> int:
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+    return path.stat().st_size
+
+
+def create(args) -> int:
+    try:
+        old_files = load_artifact(args.old)
+        new_files = load_artifact(args.new)
+        stats = create_delta(old_files, new_files, args.delta)
+    except (DeltaError, OSError, zipfile.BadZipFile) as err:
+        print("Couldn't create the delta. The error was: {}".format(err),
+              file=sys.stderr)
+        return -1
+
+    print_stats(stats)
+    print("Delta '{}': {} bytes (new artifact: {} bytes).".format(
+        args.delta, args.delta.stat().st_size, artifact_size(args.new)))
+    return 0
+
+
+def apply(args) -> int:
+    if not args.mod_dir.is_dir():
+        print("Provided path '{}' doesn't exists or is not a directory."
+              .format(args.mod_dir), file=sys.stderr)
+        return -1
+
+    try:
+        stats = apply_delta(args.mod_dir, args.delta)
+    except (DeltaError, OSError, KeyError, lzma.LZMAError,
+            zipfile.BadZipFile) as err:
+        print("Couldn't apply the delta. The error was: {}".format(err),
+              file=sys.stderr)
+        return -1
+
+    print_stats(stats)
+    print("Successfully updated '{}'.".format(args.mod_dir))
+    return 0
+
+
+def benchmark(args) -> int:
+    try:
+        old_files = load_artifact(args.old)
+        new_files = load_artifact(args.new)
+    except (DeltaError, OSError, zipfile.BadZipFile) as err:
+        print("Couldn't load the artifacts. The error was: {}".format(err),
+              file=sys.stderr)
+        return -1
+
+    create_times = list()
+    apply_times = list()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        delta_path = pathlib.Path(tmp_dir).joinpath("delta.zip")
+        mod_dir = pathlib.Path(tmp_dir).joinpath("mod")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            create_delta(old_files, new_files, delta_path)
+            create_times.append(time.perf_counter() - start)
+
+            shutil.rmtree(str(mod_dir), ignore_errors=True)
+            write_artifact(old_files, mod_dir)
+            start = time.perf_counter()
+            apply_delta(mod_dir, delta_path)
+            apply_times.append(time.perf_counter() - start)
+
+        delta_size = delta_path.stat().st_size
+
+    new_size = artifact_size(args.new)
+    print("new artifact: {} bytes, delta: {} bytes ({:.1%})".format(
+        new_size, delta_size, delta_size / new_size if new_size else 0))
+    for name, times in (("create", create_times), ("apply", apply_times)):
+        print("{:<7} min: {:.4f}s  median: {:.4f}s  max: {:.4f}s".format(
+            name, min(times), statistics.median(times), max(times)))
+
+    return 0
+
+
+def main(args):
+    banner_execute()
+    return args.func(args)
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Create or apply a delta between two release artifacts "
+                    "(zip files or mod directories).")
+    sub_parsers = arg_parser.add_subparsers(dest="command")
+    sub_parsers.required = True
+
+    create_parser = sub_parsers.add_parser(
+        "create", help="Create a delta between two artifacts.")
+    create_parser.add_argument(
+        'old', action="store", type=pathlib.Path,
+        help="Previous artifact (zip file or mod directory).")
+    create_parser.add_argument(
+        'new', action="store", type=pathlib.Path,
+        help="New artifact (zip file or mod directory).")
+    create_parser.add_argument(
+        'delta', action="store", type=pathlib.Path,
+        help="Path of the delta file to create.")
+    create_parser.set_defaults(func=create)
+
+    apply_parser = sub_parsers.add_parser(
+        "apply", help="Update a mod directory in place with a delta.")
+    apply_parser.add_argument(
+        'mod_dir', action="store", type=pathlib.Path,
+        help="Mod directory matching the previous artifact.")
+    apply_parser.add_argument(
+        'delta', action="store", type=pathlib.Path,
+        help="Delta file made with the 'create' command.")
+    apply_parser.set_defaults(func=apply)
+
+    benchmark_parser = sub_parsers.add_parser(
+        "benchmark", help="Measure the 'create' and 'apply' commands on two "
+                          "artifacts.")
+    benchmark_parser.add_argument(
+        'old', action="store", type=pathlib.Path,
+        help="Previous artifact (zip file or mod directory).")
+    benchmark_parser.add_argument(
+        'new', action="store", type=pathlib.Path,
+        help="New artifact (zip file or mod directory).")
+    benchmark_parser.add_argument(
+        '-n', '--repeat', action="store", type=int, default=5,
+        help="Number of runs. [default: 5]")
+    benchmark_parser.set_defaults(func=benchmark)
+
+    parsed_args = arg_parser.parse_args()
+    sys.exit(main(parsed_args))
@@ -0,0 +1,319 @@
+#!/usr/bin/python3.6
+# -*- coding: UTF-8 -*-
+import argparse
+import contextlib
+import datetime
+import functools
+import os
+import pathlib
+import platform
+import sqlite3
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+# Environment variable overriding the database location; set it to an empty
+# string to disable the recording.
+DB_ENV_VAR = "PL_TIMINGS_DB"
+
+# Default location of the database.
+DEFAULT_DB_PATH = pathlib.Path(os.path.realpath(__file__)).parent.joinpath(
+    ".cache", "timings.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    script TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    host TEXT NOT NULL,
+    duration REAL NOT NULL,
+    return_code INTEGER
+);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL,
+    duration REAL NOT NULL,
+    bytes INTEGER NOT NULL,
+    cache_hits INTEGER NOT NULL,
+    cache_misses INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stages_run_id ON stages(run_id);
+"""
+
+
+class Stage(object):
+    """Measures of a single stage of a script run."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.duration = 0.0
+        self.bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+class StageRecorder(object):
+    """Collects the stages of a script run and saves them in the database."""
+
+    def __init__(self, script: str):
+        self.script = script
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.start = time.perf_counter()
+        self.stages = list()  # type: List[Stage]
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        stage = Stage(name)
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.duration = time.perf_counter() - start
+            self.stages.append(stage)
+
+    def save(self, return_code: Optional[int],
+             db_path: Optional[pathlib.Path] = None):
+        db_path = db_path or get_db_path()
+        if db_path is None:
+            return
+
+        duration = time.perf_counter() - self.start
+        os.makedirs(str(db_path.parent), exist_ok=True)
+        with contextlib.closing(connect(db_path)) as db, db:
+            cursor = db.execute(
+                "INSERT INTO runs (script, started_at, host, duration, "
+                "return_code) VALUES (?, ?, ?, ?, ?)",
+                (self.script, self.started_at.isoformat(), platform.node(),
+                 duration, return_code))
+            db.executemany(
+                "INSERT INTO stages (run_id, name, duration, bytes, "
+                "cache_hits, cache_misses) VALUES (?, ?, ?, ?, ?, ?)",
+                [(cursor.lastrowid, s.name, s.duration, s.bytes,
+                  s.cache_hits, s.cache_misses) for s in self.stages])
+
+
+# recorder of the script currently running (see `record`).
+_current_recorder = None  # type: Optional[StageRecorder]
+
+
+def get_db_path() -> Optional[pathlib.Path]:
+    db_path = os.environ.get(DB_ENV_VAR)
+    if db_path is None:
+        return DEFAULT_DB_PATH
+    return pathlib.Path(db_path) if db_path else None
+
+
+def connect(db_path: pathlib.Path) -> sqlite3.Connection:
+    db = sqlite3.connect(str(db_path))
+    db.executescript(SCHEMA)
+    return db
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Time a stage of the current script run.
+
+    The yielded `Stage` can be used to count bytes and cache hits / misses.
+    Outside of a recorded run (see `record`), the stage is simply dropped.
+    """
+    if _current_recorder is None:
+        yield Stage(name)
+        return
+
+    with _current_recorder.stage(name) as current_stage:
+        yield current_stage
+
+
+def record(script: str) -> Callable:
+    """Decorator for a script `main` function: record its stages and its
+    return code in the timings database.
+
+    Failing to save the timings never makes the script fail.
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            global _current_recorder
+            _current_recorder = StageRecorder(script)
+            return_code = None
+            try:
+                return_code = func(*args, **kwargs)
+                return return_code
+            finally:
+                recorder, _current_recorder = _current_recorder, None
+                try:
+                    recorder.save(return_code)
+                except (OSError, sqlite3.Error) as err:
+                    print("Couldn't save stage timings. The error was: {}"
+                          .format(err), file=sys.stderr)
+        return wrapper
+    return decorator
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Percentile with linear interpolation between the closest ranks."""
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * percent / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def load_series(db: sqlite3.Connection, script: Optional[str],
+                include_failures: bool = False) -> Dict[tuple, List[tuple]]:
+    """Load the stage measures, summed per run.
+
+    Failed runs (non-zero or unknown return code) are skipped unless
+    `include_failures` is set: they usually stop early and would skew the
+    percentiles and the baseline.
+
+    Returns (script, stage) -> list of (run id, duration, bytes, cache hits,
+    cache misses), oldest run first.
+    """
+    query = ("SELECT runs.script, stages.name, runs.id, SUM(stages.duration), "
+             "SUM(stages.bytes), SUM(stages.cache_hits), "
+             "SUM(stages.cache_misses) FROM stages "
+             "JOIN runs ON runs.id = stages.run_id ")
+    conditions = list()
+    params = list()
+    if not include_failures:
+        conditions.append("runs.return_code = 0")
+    if script:
+        conditions.append("runs.script = ?")
+        params.append(script)
+    if conditions:
+        query += "WHERE {} ".format(" AND ".join(conditions))
+    query += "GROUP BY runs.id, stages.name ORDER BY runs.id"
+
+    series = dict()
+    for row in db.execute(query, params):
+        series.setdefault((row[0], row[1]), list()).append(row[2:])
+    return series
+
+
+def format_bytes(count: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if count < 1024:
+            return "{:.0f}{}".format(count, unit)
+        count /= 1024
+    return "{:.1f}GB".format(count)
+
+
+def report(args) -> int:
+    db_path = args.db or get_db_path()
+    if db_path is None or not db_path.exists():
+        print("No timings database found.", file=sys.stderr)
+        return -1
+
+    with contextlib.closing(connect(db_path)) as db:
+        series = load_series(db, args.script, args.include_failures)
+
+    if not series:
+        print("No stage recorded yet.")
+        return 0
+
+    print("{:<40} {:>5} {:>8} {:>8} {:>8} {:>8} {:>10} {:>6}".format(
+        "script / stage", "runs", "p50", "p90", "p99", "last", "bytes/s",
+        "cache"))
+    regressions = list()
+    for (script, stage_name), rows in sorted(series.items()):
+        rows = rows[-args.history:]
+        durations = [row[1] for row in rows]
+        total_bytes = sum(row[2] for row in rows)
+        hits = sum(row[3] for row in rows)
+        lookups = hits + sum(row[4] for row in rows)
+        throughput = total_bytes / sum(durations) if sum(durations) else 0
+        print("{:<40} {:>5} {:>7.3f}s {:>7.3f}s {:>7.3f}s {:>7.3f}s {:>10} "
+              "{:>6}".format(
+                  "{} / {}".format(script, stage_name)[:40], len(rows),
+                  percentile(durations, 50), percentile(durations, 90),
+                  percentile(durations, 99), durations[-1],
+                  format_bytes(throughput) if total_bytes else "-",
+                  "{:.0%}".format(hits / lookups) if lookups else "-"))
+
+        # compare the last run with the median of the previous ones.
+        baseline = durations[-args.window - 1:-1]
+        if len(baseline) >= args.min_baseline:
+            median = statistics.median(baseline)
+            delta = durations[-1] - median
+            # tiny stages are mostly jitter: only keep real slowdowns.
+            if median > 0 and delta >= args.min_delta and \
+                    durations[-1] / median >= args.threshold:
+                regressions.append((delta, script, stage_name, median,
+                                    durations[-1]))
+
+    # the most seconds lost first.
+    regressions.sort(reverse=True)
+    print("\nRegressions (last run vs. median of the previous {} runs, "
+          ">= x{:.2f} and >= +{:.3f}s):".format(
+              args.window, args.threshold, args.min_delta))
+    if not regressions:
+        print("\tnone")
+    for delta, script, stage_name, median, last in regressions[:args.top]:
+        print("\t{} / {}: {:.3f}s -> {:.3f}s (+{:.3f}s, x{:.2f})".format(
+            script, stage_name, median, last, delta, last / median))
+
+    return 0
+
+
+def banner_execute() -> pathlib.Path:
+    script_path = pathlib.Path(os.path.realpath(__file__))
+    sep = "-" * 79
+    print("{}\nExecuting: {}\n{}".format(sep, script_path.name, sep))
+    return script_path
+
+
+def main(args):
+    banner_execute()
+    return report(args)
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Report the stage timings recorded by the tools scripts "
+                    "(trends, percentiles and regressions).")
+
+    arg_parser.add_argument(
+        '--db', action="store", type=pathlib.Path,
+        help="Timings database path. [default: ${} or "
+             "tools/.cache/timings.sqlite3]".format(DB_ENV_VAR))
+
+    arg_parser.add_argument(
+        '-s', '--script', action="store",
+        help="Only report this script (e.g. 'extract_archive').")
+
+    arg_parser.add_argument(
+        '-f', '--include_failures', action="store_true", default=False,
+        help="Also report the runs that failed (non-zero or no return code). "
+             "[default: False]")
+
+    arg_parser.add_argument(
+        '-H', '--history', action="store", type=int, default=100,
+        help="Number of most recent runs used for the percentiles. "
+             "[default: 100]")
+
+    arg_parser.add_argument(
+        '-w', '--window', action="store", type=int, default=10,
+        help="Number of previous runs in the rolling baseline. [default: 10]")
+
+    arg_parser.add_argument(
+        '--min_baseline', action="store", type=int, default=3,
+        help="Minimum number of previous runs to look for a regression. "
+             "[default: 3]")
+
+    arg_parser.add_argument(
+        '-t', '--threshold', action="store", type=float, default=1.2,
+        help="Minimum slowdown ratio reported as a regression. "
+             "[default: 1.2]")
+
+    arg_parser.add_argument(
+        '-d', '--min_delta', action="store", type=float, default=0.05,
+        help="Minimum slowdown (in seconds) reported as a regression. "
+             "[default: 0.05]")
+
+    arg_parser.add_argument(
+        '-n', '--top', action="store", type=int, default=10,
+        help="Number of regressions shown. [default: 10]")
+
+    parsed_args = arg_parser.parse_args()
+    sys.exit(main(parsed_args))
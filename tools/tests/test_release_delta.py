@@ -0,0 +1,148 @@
+# -*- coding: UTF-8 -*-
+import json
+import os
+import pathlib
+import random
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent))
+import release_delta  # noqa: E402
+
+
+class DiffPatchTest(unittest.TestCase):
+    def assert_round_trip(self, old: bytes, new: bytes):
+        patch_data = release_delta.diff(old, new)
+        self.assertEqual(release_delta.patch(old, patch_data), new)
+
+    def test_round_trip(self):
+        rng = random.Random(42)
+        old = bytes(rng.getrandbits(8) for _ in range(100000))
+        new = bytearray(old)
+        # overwrite, insert and delete some ranges.
+        new[1000:1100] = b"x" * 100
+        new[5000:5000] = b"inserted bytes"
+        del new[70000:71000]
+        self.assert_round_trip(old, bytes(new))
+
+    def test_round_trip_edge_cases(self):
+        data = b"PrepareLanding" * 100
+        self.assert_round_trip(b"", data)
+        self.assert_round_trip(data, b"")
+        self.assert_round_trip(data, data)
+        self.assert_round_trip(b"short", b"tiny")
+
+    def test_unknown_opcode(self):
+        patch_data = release_delta.lzma.compress(b"X1234")
+        with self.assertRaises(release_delta.DeltaError):
+            release_delta.patch(b"", patch_data)
+
+
+class ApplyDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dir = pathlib.Path(self._tmp_dir.name)
+        self.mod_dir = self.tmp_dir.joinpath("mod")
+        self.delta_path = self.tmp_dir.joinpath("delta.zip")
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_apply(self):
+        old_files = {
+            "About/About.xml": b"<about>1</about>" * 50,
+            "Languages/English/Keyed/A.xml": b"<a/>",
+            "Languages/English/Keyed/B.xml": b"<b/>",
+            "Textures/icon.png": b"png",
+        }
+        new_files = {
+            "About/About.xml": b"<about>2</about>" * 50,
+            "Languages/English/Keyed/PrepareLanding.xml": b"<a/><b/>",
+            "Textures/icon.png": b"png",
+        }
+        release_delta.write_artifact(old_files, self.mod_dir)
+        release_delta.create_delta(old_files, new_files, self.delta_path)
+
+        stats = release_delta.apply_delta(self.mod_dir, self.delta_path)
+
+        self.assertEqual(release_delta.load_artifact(self.mod_dir), new_files)
+        self.assertEqual(stats["removed"], 2)
+        self.assertEqual(stats["unchanged"], 1)
+
+    def test_apply_removes_empty_dirs(self):
+        old_files = {
+            "Languages/English/Keyed/A.xml": b"<a/>",
+            "Languages/French/Keyed/A.xml": b"<a/>",
+            "Textures/icon.png": b"png",
+        }
+        new_files = {
+            "Languages/French/Keyed/A.xml": b"<a/>",
+            "Textures/icon.png": b"png",
+        }
+        release_delta.write_artifact(old_files, self.mod_dir)
+        release_delta.create_delta(old_files, new_files, self.delta_path)
+
+        release_delta.apply_delta(self.mod_dir, self.delta_path)
+
+        self.assertFalse(
+            self.mod_dir.joinpath("Languages", "English").exists())
+        self.assertTrue(self.mod_dir.joinpath("Languages", "French").is_dir())
+
+    def write_delta(self, manifest: dict, members: dict):
+        manifest = dict(manifest, format=release_delta.DELTA_FORMAT)
+        with zipfile.ZipFile(str(self.delta_path), "w") as delta:
+            for name, data in members.items():
+                delta.writestr(name, data)
+            delta.writestr(release_delta.MANIFEST_NAME, json.dumps(manifest))
+
+    def test_reject_invalid_names(self):
+        os.makedirs(str(self.mod_dir))
+        data = b"evil"
+        digest = release_delta.sha256(data)
+        for name in ("../evil.txt", "About/../../evil.txt", "/tmp/evil.txt",
+                     "C:/evil.txt", "C:evil.txt", "\\evil.txt",
+                     "\\\\server\\share\\evil.txt", "About\\..\\..\\evil.txt",
+                     ""):
+            with self.subTest(name=name):
+                self.write_delta(
+                    {"old": {}, "new": {name: digest},
+                     "files": {name: "full"}, "removed": []},
+                    {"full/" + name: release_delta.lzma.compress(data)})
+                with self.assertRaises(release_delta.DeltaError):
+                    release_delta.apply_delta(self.mod_dir, self.delta_path)
+                self.assertEqual(list(self.tmp_dir.rglob("evil.txt")), [])
+
+    def test_reject_removed_outside(self):
+        os.makedirs(str(self.mod_dir))
+        outside = self.tmp_dir.joinpath("keep.txt")
+        outside.write_bytes(b"keep")
+        self.write_delta(
+            {"old": {}, "new": {}, "files": {}, "removed": ["../keep.txt"]},
+            {})
+        with self.assertRaises(release_delta.DeltaError):
+            release_delta.apply_delta(self.mod_dir, self.delta_path)
+        self.assertTrue(outside.exists())
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "needs symlinks")
+    def test_reject_symlink_escape(self):
+        os.makedirs(str(self.mod_dir))
+        outside_dir = self.tmp_dir.joinpath("outside")
+        os.makedirs(str(outside_dir))
+        try:
+            os.symlink(str(outside_dir), str(self.mod_dir.joinpath("link")))
+        except OSError:
+            self.skipTest("symlinks not allowed")
+        data = b"evil"
+        self.write_delta(
+            {"old": {}, "new": {"link/evil.txt": release_delta.sha256(data)},
+             "files": {"link/evil.txt": "full"}, "removed": []},
+            {"full/link/evil.txt": release_delta.lzma.compress(data)})
+        with self.assertRaises(release_delta.DeltaError):
+            release_delta.apply_delta(self.mod_dir, self.delta_path)
+        self.assertFalse(outside_dir.joinpath("evil.txt").exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+#!/usr/bin/python3.6
+# -*- coding: UTF-8 -*-
+import asyncio
+import collections
+import re
+import sys
+import time
+from typing import Callable, Deque, List, Optional
+
+# Size of the reads on the tool pipes (also bounds the stream buffers).
+READ_SIZE = 1 << 16
+
+# Lines longer than this are split in several lines (e.g. a tool writing
+# without newlines).
+MAX_LINE_LENGTH = 1 << 16
+
+# Number of lines kept per stream in a result.
+TAIL_SIZE = 200
+
+# Line separators; 7z rewrites its progress line with '\b' or '\r'.
+LINE_SEPARATORS = re.compile(rb"[\r\n\b]")
+
+# 7z progress, e.g.: ' 42% 3 - Assembly-CSharp.dll'
+PROGRESS_RE = re.compile(r"^\s*(\d{1,3})%")
+
+# Adaptive timeout: base time plus time per MB of input.
+TIMEOUT_BASE = 10.0
+TIMEOUT_PER_MB = 1.0
+
+LineCallback = Callable[[str, str, str], None]
+ProgressCallback = Callable[[str, int], None]
+
+
+class ToolCommand(object):
+    def __init__(self, args: List[str], name: Optional[str] = None,
+                 timeout: Optional[float] = None):
+        self.args = [str(arg) for arg in args]
+        self.name = name or self.args[0]
+        self.timeout = timeout
+
+
+class ToolResult(object):
+    def __init__(self, command: ToolCommand):
+        self.command = command
+        self.return_code = None  # type: Optional[int]
+        # set if the tool couldn't be started.
+        self.error = None  # type: Optional[OSError]
+        self.timed_out = False
+        self.duration = 0.0
+        self.stdout = collections.deque(maxlen=TAIL_SIZE)  # type: Deque[str]
+        self.stderr = collections.deque(maxlen=TAIL_SIZE)  # type: Deque[str]
+
+
+def adaptive_timeout(input_size: int, base: float = TIMEOUT_BASE,
+                     per_mb: float = TIMEOUT_PER_MB) -> float:
+    """Timeout (in seconds) scaled from the size (in bytes) of the tool
+    input."""
+    return base + per_mb * input_size / (1 << 20)
+
+
+def print_line(name: str, stream_name: str, line: str):
+    print("[{}] {}".format(name, line),
+          file=sys.stderr if stream_name == "stderr" else sys.stdout)
+
+
+def print_progress(name: str, percent: int):
+    print("[{}] {}%".format(name, percent))
+
+
+async def _read_stream(stream: asyncio.StreamReader, name: str,
+                       stream_name: str, tail: Deque[str],
+                       on_line: Optional[LineCallback],
+                       on_progress: Optional[ProgressCallback]):
+    last_percent = None
+
+    def handle(raw_line: bytes):
+        nonlocal last_percent
+        line = raw_line.decode("utf-8", errors="replace").rstrip()
+        if not line.strip():
+            return
+        match = PROGRESS_RE.match(line)
+        if match:
+            percent = int(match.group(1))
+            if percent != last_percent and on_progress:
+                on_progress(name, percent)
+            last_percent = percent
+            return
+        tail.append(line)
+        if on_line:
+            on_line(name, stream_name, line)
+
+    pending = b""
+    while True:
+        chunk = await stream.read(READ_SIZE)
+        if not chunk:
+            break
+        lines = LINE_SEPARATORS.split(pending + chunk)
+        pending = lines.pop()
+        if len(pending) > MAX_LINE_LENGTH:
+            lines.append(pending[:MAX_LINE_LENGTH])
+            pending = b""
+        for raw_line in lines:
+            handle(raw_line)
+
+    if pending:
+        handle(pending)
+
+
+async def run_tool(command: ToolCommand,
+                   on_line: Optional[LineCallback] = print_line,
+                   on_progress: Optional[ProgressCallback] = None) \
+        -> ToolResult:
+    """Run a tool, streaming its output until it exits or times out."""
+    result = ToolResult(command)
+    start = time.perf_counter()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command.args, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE, limit=READ_SIZE)
+    except OSError as err:
+        result.error = err
+        return result
+
+    tasks = [
+        asyncio.ensure_future(_read_stream(
+            process.stdout, command.name, "stdout", result.stdout, on_line,
+            on_progress)),
+        asyncio.ensure_future(_read_stream(
+            process.stderr, command.name, "stderr", result.stderr, on_line,
+            on_progress)),
+        asyncio.ensure_future(process.wait())]
+    _, pending = await asyncio.wait(tasks, timeout=command.timeout)
+    if pending:
+        result.timed_out = True
+        process.kill()
+        for task in pending:
+            task.cancel()
+        # retrieve all the outcomes, otherwise the cancellations are logged
+        #  as never retrieved exceptions.
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await process.wait()
+    else:
+        await asyncio.gather(*tasks)
+
+    result.return_code = process.returncode
+    result.duration = time.perf_counter() - start
+    return result
+
+
+async def run_tools(commands: List[ToolCommand], max_concurrency: int = 1,
+                    on_line: Optional[LineCallback] = print_line,
+                    on_progress: Optional[ProgressCallback] = None) \
+        -> List[ToolResult]:
+    """Run several tools, at most `max_concurrency` at the same time.
+
+    Results are in the same order as the commands.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def run_one(command: ToolCommand) -> ToolResult:
+        async with semaphore:
+            return await run_tool(command, on_line, on_progress)
+
+    return await asyncio.gather(*(run_one(command) for command in commands))
+
+
+def run(coroutine):
+    """Run a coroutine in a new event loop (subprocesses on Windows need the
+    proactor loop, which isn't the default before Python 3.8)."""
+    if sys.platform == "win32":
+        loop = asyncio.ProactorEventLoop()
+    else:
+        loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()